@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Manifest of the files of the data directory.
+
+  One row per file: path, market, timestamp (parsed once from the name), size,
+  mtime and done (its ticks are in the database). It is saved next to the data and
+  refreshed with one os.scandir per year directory, only new or changed files
+  (other size or mtime) have their name parsed again and are marked not done.
+
+  Work is planned on it: files of a market in chronological order, cut into
+  shards of about the same number of bytes.
+
+  >>> files = pd.DataFrame({'path': list('abcdef'), 'size': [10, 10, 10, 10, 40, 20]})
+  >>> [list(s['path']) for s in shards(files, 3)]
+  [['a', 'b', 'c', 'd'], ['e'], ['f']]
+  >>> [list(s['path']) for s in shards(files.iloc[:2], 12)]
+  [['a'], ['b']]
+
+  Other files of the year directories (.DS_Store, partial downloads) are not in it:
+
+  >>> names = ['compA 2023-01-02 09:10:01.5.bz2', '.DS_Store', 'README', 'compA 2023-01-02 09:10:01.5.bz2.part']
+  >>> [bool(FILE_NAME.fullmatch(name)) for name in names]
+  [True, False, False, False]
+'''
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['path', 'market', 'timestamp', 'size', 'mtime', 'done']
+FILE_NAME = re.compile(r'(\S+) (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{1,6})\.bz2')  # boursorama file
+
+
+def parse_timestamp(path):
+    '''Timestamp of a boursorama file from its name: "<market> <YYYY-MM-DD> <HH:MM:SS.ffffff>.bz2"'''
+    return pd.to_datetime(FILE_NAME.fullmatch(os.path.basename(path)).group(2), format='%Y-%m-%d %H:%M:%S.%f')
+
+
+def shards(files, n):
+    '''
+    Cut files (in their order) into at most n contiguous shards of about the same total size
+
+    A shard ends when its cumulated size reaches the next multiple of total / n,
+    so a big file is not split and there are no empty shards.
+    '''
+    if len(files) == 0:
+        return []
+    ends = np.cumsum(files['size'].to_numpy(dtype=np.float64))
+    # shard of each file: number of 1/n of the total passed before it
+    before = np.concatenate([[0.0], ends[:-1]])
+    ids = np.minimum((before * n // max(ends[-1], 1)).astype(np.int64), n - 1)
+    cuts = np.flatnonzero(np.diff(ids)) + 1
+    return [files.iloc[a:b] for a, b in zip(np.concatenate([[0], cuts]), np.concatenate([cuts, [len(files)]]))]
+
+
+class Manifest:
+    """ Files of the data directory with their parsed timestamp, size, mtime and done flag."""
+
+    def __init__(self, data_dir, filename=None):
+        '''
+        data_dir -- directory with one sub directory per year (data/boursorama)
+        filename -- where the manifest is saved, data_dir/.manifest.pkl by default
+        '''
+        self.data_dir = data_dir
+        self.filename = filename or os.path.join(data_dir, '.manifest.pkl')
+        if os.path.exists(self.filename):
+            self.files = pd.read_pickle(self.filename)
+        else:
+            self.files = pd.DataFrame({c: pd.Series(dtype=t) for c, t in
+                                       zip(COLUMNS, [object, object, 'datetime64[ns]', np.int64, np.float64, bool])})
+        self.refresh()
+
+    def refresh(self, years=None):
+        '''
+        Add the new files, mark the changed ones not done and forget the removed ones.
+        Only the names of boursorama files (FILE_NAME) are kept.
+
+        :param years: only scan these year directories, the files of the others are kept as they are
+        '''
+        if years is None:
+            years = sorted(os.listdir(self.data_dir))
+            outside = np.zeros(len(self.files), dtype=bool)
+        else:
+            prefixes = tuple(os.path.join(self.data_dir, str(year)) + os.sep for year in years)
+            outside = ~self.files['path'].str.startswith(prefixes).to_numpy(dtype=bool)
+        seen = []
+        for year in years:
+            directory = os.path.join(self.data_dir, str(year))
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and FILE_NAME.fullmatch(entry.name):
+                        stat = entry.stat()
+                        seen.append((entry.path, stat.st_size, stat.st_mtime))
+        seen = pd.DataFrame(seen, columns=['path', 'size', 'mtime'])
+        known = self.files[~outside].set_index('path')
+        same = seen['path'].isin(known.index).to_numpy().copy()
+        if same.any():
+            old = known.loc[seen['path'][same]]
+            same[same] = (old['size'].to_numpy() == seen['size'][same].to_numpy()) & \
+                         (old['mtime'].to_numpy() == seen['mtime'][same].to_numpy())
+        kept = known.loc[seen['path'][same]].reset_index()
+        new = seen[~same].copy()
+        new['market'] = [os.path.basename(p).split(' ')[0] for p in new['path']]
+        new['timestamp'] = pd.to_datetime([parse_timestamp(p) for p in new['path']]) if len(new) \
+            else pd.Series(dtype='datetime64[ns]')
+        new['done'] = False
+        self.files = pd.concat([self.files[outside], kept[COLUMNS], new[COLUMNS]], ignore_index=True) \
+            .sort_values(['timestamp', 'path'], ignore_index=True)
+        return len(new)
+
+    def select(self, market, start=None, end=None, pending=False):
+        '''
+        Files of a market in chronological order
+
+        :param start: first timestamp (included), end: last timestamp (excluded)
+        :param pending: only the files not done
+        '''
+        keep = (self.files['market'] == market).to_numpy().copy()
+        if start is not None:
+            keep &= (self.files['timestamp'] >= pd.Timestamp(start)).to_numpy()
+        if end is not None:
+            keep &= (self.files['timestamp'] < pd.Timestamp(end)).to_numpy()
+        if pending:
+            keep &= ~self.files['done'].to_numpy()
+        return self.files[keep]
+
+    def mark_done(self, paths, done=True):
+        self.files.loc[self.files['path'].isin(paths), 'done'] = done
+
+    def reset_done(self):
+        self.files['done'] = False
+
+    def save(self):
+        # written under another name first, a crash does not leave half a manifest
+        self.files.to_pickle(self.filename + '.tmp')
+        os.replace(self.filename + '.tmp', self.filename)
@@ -8,6 +8,14 @@
   de ne rien mettre dans les autres fichier ainsi il suffit de modifier la valeur
   par défaut ici pour que toute la bibliothèque change le seuil.
 
+  Les loggers n'écrivent pas eux-mêmes : ils déposent les messages dans une queue
+  (QueueHandler) et un thread (QueueListener) les écrit dans le fichier ou sur la
+  console. Il y a une queue et un thread par destination et par processus, pas par
+  appel, donc appeler getLogger plusieurs fois n'écrit pas les lignes plusieurs fois.
+  Un processus créé par fork (Pool, Process) démarre son propre thread au premier
+  message. Seul le processus principal fait la rotation du fichier, les autres
+  écrivent à la fin du fichier courant.
+
   cf https://docs.python.org/2/howto/logging.html pour la doc
 
   >>> from testfixtures import LogCapture
@@ -19,34 +27,79 @@
 
 import logging
 import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import threading
 
 INFO = logging.INFO
 DEBUG = logging.DEBUG
 
 log_level = logging.DEBUG  # change this if you want a another default variable
 
+_main_pid = os.getpid()
+_lock = threading.Lock()
+_queues = {}  # destination (file name or None for the console) -> queue read by the writer thread of this process
+
+
+def _reset_after_fork():
+    # the threads of the parent do not exist in the child, nor its queues
+    global _lock, _queues
+    _lock = threading.Lock()
+    _queues = {}
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _queue(filename):
+    '''Return the queue of a destination in this process, starting its writer thread the first time'''
+    with _lock:
+        if filename not in _queues:
+            if filename is None:
+                handler = logging.StreamHandler()
+            elif os.getpid() == _main_pid:
+                handler = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=3)
+            else:
+                # follows the file when the main process rotates it
+                handler = logging.handlers.WatchedFileHandler(filename)
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            _queues[filename] = queue.Queue(-1)
+            listener = logging.handlers.QueueListener(_queues[filename], handler)
+            listener.start()
+            # write what is left in the queue when the process (or a multiprocessing child) exits
+            multiprocessing.util.Finalize(None, listener.stop, exitpriority=10)
+        return _queues[filename]
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler which finds the queue of its destination again after a fork."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = os.getpid()
+        super().__init__(_queue(filename))
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.queue = _queue(self.filename)
+            self.pid = os.getpid()
+        self.queue.put_nowait(record)
+
+
 def getLogger(name, level=log_level,
               filename=None, file_level=None):
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    # create file handle if needed
-    if filename is not None:
-        fh = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=3)
-        if file_level is None:
-            fh.setLevel(level)
-        else:
-            fh.setLevel(file_level)
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
-    else:
-        # create console handler and set level to debug
-        sh = logging.StreamHandler()
-        sh.set_name("handler of %s" % name)
-        sh.setLevel(level)
-        sh.setFormatter(formatter)
-        logger.addHandler(sh)
+    handler_level = level if filename is None or file_level is None else file_level
+    for handler in logger.handlers:
+        if isinstance(handler, _QueueHandler) and handler.filename == filename:
+            # already set up by a previous call, do not write every line twice
+            handler.setLevel(handler_level)
+            return logger
+    # records are formatted by the writer thread, the caller only merges the
+    # message with its arguments, and only when the level lets the record through
+    qh = _QueueHandler(filename)
+    qh.set_name("handler of %s" % name)
+    qh.setLevel(handler_level)
+    logger.addHandler(qh)
     return logger
-
-
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Bourse model stored in Parquet files, to run the analyzer and the dashboard
+  without the docker stack.
+
+  root/
+    markets.parquet
+    companies/*.parquet                    one file per write_companies
+    stocks/mid=<mid>/year=<year>/*.parquet one file per write_ticks
+    daystocks/mid=<mid>/year=<year>/*.parquet
+    views.sql                              the tables of the Timescale model as DuckDB views
+
+  Files are only added (each process writes its own files) so the workers of
+  the analyzer write at the same time without lock. aggregate_days, which runs
+  alone in the main process, merges the files of a partition once there are
+  more than COMPACT_FILES, so that watch does not leave one small file per
+  batch (see _compact for a merge stopped half way). Reads go through DuckDB,
+  views.sql defines stocks, daystocks, companies, markets and the tables that
+  Timescale keeps up to date (stocksummary, companysummary, dayreturns,
+  marketindex) as views computed when read. Ticks are never rolled up here,
+  hourstocks is empty. The dashboard runs its queries on these views, see
+  BOURSE_DATABASE_URI in bourse.py.
+
+  pip install duckdb pyarrow
+'''
+
+import glob
+import json
+import os
+import uuid
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import mylogging
+import profiling
+import storage
+
+MARKETS = [(1, 'NYSE Euronext', 'euronx'), (2, 'London Stock Exchange', 'lse'), (3, 'Bourse Italienne', 'milano'),
+           (4, 'Bourse Allemande', 'dbx'), (5, 'Bourse Espagnole', 'mercados'), (6, 'Amsterdam', 'amsterdam'),
+           (7, 'Paris compartiment A', 'compA'), (8, 'Paris compartiment B', 'compB'),
+           (9, 'Bourse Allemande', 'xetra'), (10, 'Bruxelle', 'bruxelle')]
+
+COMPACT_FILES = 16  # files of a stocks or daystocks partition merged into one above this
+
+# Empty tables, written once so that the views can be read before the first load
+EMPTY = {
+    'companies': pd.DataFrame({'id': np.array([], dtype=np.int16), 'name': pd.Series([], dtype='string'),
+                               'mid': np.array([], dtype=np.int16), 'symbol': pd.Series([], dtype='string'),
+                               'pea': np.array([], dtype=bool)}),
+    'stocks': pd.DataFrame({'date': np.array([], dtype='datetime64[us]'), 'cid': np.array([], dtype=np.int16),
+                            'value': np.array([], dtype=np.float32), 'volume': np.array([], dtype=np.int64)}),
+    'daystocks': pd.DataFrame({'date': np.array([], dtype='datetime64[us]'), 'cid': np.array([], dtype=np.int16),
+                               'open': np.array([], dtype=np.float32), 'close': np.array([], dtype=np.float32),
+                               'high': np.array([], dtype=np.float32), 'low': np.array([], dtype=np.float32),
+                               'volume': np.array([], dtype=np.int64)}),
+}
+
+VIEWS = '''
+CREATE OR REPLACE VIEW markets AS
+  SELECT * FROM read_parquet('{root}/markets.parquet');
+CREATE OR REPLACE VIEW companies AS
+  SELECT * FROM read_parquet('{root}/companies/*.parquet');
+CREATE OR REPLACE VIEW stocks AS
+  SELECT date, cid, value, volume FROM read_parquet('{root}/stocks/*/*/*.parquet', hive_partitioning = true);
+CREATE OR REPLACE VIEW daystocks AS
+  SELECT date, cid, open, close, high, low, volume FROM read_parquet('{root}/daystocks/*/*/*.parquet', hive_partitioning = true);
+CREATE OR REPLACE VIEW hourstocks AS
+  SELECT date, cid, open, close, high, low, volume, 0 AS ticks, 0.0::double AS value_sum
+  FROM daystocks WHERE false;
+CREATE OR REPLACE VIEW stocksummary AS
+  SELECT s.cid, s.year, s.first_date, s.last_date, s.ticks, coalesce(d.days, 0) AS days,
+         s.low, s.high, s.value_sum, s.volume
+  FROM (SELECT cid, year(date)::smallint AS year, min(date) AS first_date, max(date) AS last_date,
+               count(*) AS ticks, min(value) AS low, max(value) AS high,
+               sum(value::double) AS value_sum, sum(volume) AS volume
+        FROM stocks GROUP BY 1, 2) s
+  LEFT JOIN (SELECT cid, year(date)::smallint AS year, count(*) AS days FROM daystocks GROUP BY 1, 2) d
+    USING (cid, year);
+CREATE OR REPLACE VIEW companysummary AS
+  SELECT cid, min(first_date) AS first_date, max(last_date) AS last_date,
+         sum(ticks) AS ticks, sum(days) AS days, min(low) AS low, max(high) AS high,
+         sum(value_sum) / NULLIF(sum(ticks), 0) AS mean, sum(volume) AS volume
+  FROM stocksummary
+  GROUP BY cid;
+CREATE OR REPLACE VIEW dayreturns AS
+  SELECT d.date, d.cid, c.mid, d.close, d.volume,
+         d.close / NULLIF(lag(d.close) OVER w, 0) - 1 AS ret,
+         d.volume / NULLIF(avg(d.volume) OVER (w ROWS BETWEEN 20 PRECEDING AND 1 PRECEDING), 0) AS volume_ratio
+  FROM daystocks d JOIN companies c ON c.id = d.cid
+  WINDOW w AS (PARTITION BY d.cid ORDER BY d.date);
+CREATE OR REPLACE VIEW marketindex AS
+  SELECT date, mid, count(*)::smallint AS companies, sum(volume) AS volume,
+         avg(ret) AS equal_ret, sum(ret * volume) / NULLIF(sum(volume), 0) AS volume_ret
+  FROM dayreturns
+  WHERE ret > -1
+  GROUP BY date, mid;
+'''
+
+
+def create_views(connection, root):
+    '''Define the tables of root as views of a DuckDB connection'''
+    with open(os.path.join(root, 'views.sql')) as f:
+        connection.execute(f.read().format(root=root))
+
+
+class ParquetStockMarketModel(storage.StockMarketStorage):
+    """ Bourse model with Parquet files persistence."""
+
+    def __init__(self, root, is_thread=False):
+        """Create a ParquetStockMarketModel
+
+        root      -- directory of the Parquet files, created if needed
+        is_thread -- the directory is already set up by the main process
+        """
+        self.logger = mylogging.getLogger(__name__, filename="/tmp/bourse.log")
+        self.root = os.path.abspath(root)
+        self.__connection = None  # DuckDB, opened on the first read
+        self.profiler = profiling.QueryProfiler()
+        if not is_thread:
+            self._setup_database()
+
+    def _setup_database(self):
+        os.makedirs(self.root, exist_ok=True)
+        markets = os.path.join(self.root, 'markets.parquet')
+        if not os.path.exists(markets):
+            pd.DataFrame(MARKETS, columns=['id', 'name', 'alias']).astype({'id': np.int16}).to_parquet(markets, index=False)
+        for table, df in EMPTY.items():
+            if table == 'companies':
+                if not glob.glob(os.path.join(self.root, 'companies', '*.parquet')):
+                    self._write(df, 'companies')
+            elif not glob.glob(os.path.join(self.root, table, '*', '*', '*.parquet')):
+                self._write(df, table, mid=0, year=0)
+        with open(os.path.join(self.root, 'views.sql'), 'w') as f:
+            f.write(VIEWS)
+        for journal in glob.glob(os.path.join(self.root, '*', '*', '*', 'compact.json')):
+            self._finish_compact(journal)
+
+    def _write(self, df, table, mid=None, year=None):
+        '''Add a file to a table, in the partition of (mid, year) for stocks and daystocks'''
+        directory = os.path.join(self.root, table)
+        if mid is not None:
+            directory = os.path.join(directory, f'mid={int(mid)}', f'year={int(year)}')
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory, f'{os.getpid()}-{uuid.uuid4().hex}.parquet')
+        with self.profiler.timed('write_parquet', None):
+            # written under another name first, readers never see half a file
+            df.to_parquet(filename + '.tmp', index=False)
+            os.replace(filename + '.tmp', filename)
+
+    def _write_partitions(self, df, table, mids):
+        '''Split df by market and year, mids gives the market of each row'''
+        years = pd.DatetimeIndex(df['date']).year.to_numpy()
+        for (mid, year), rows in df.groupby([np.asarray(mids), years], sort=False):
+            self._write(rows, table, mid=mid, year=year)
+
+    def _query(self, query, args=None):
+        '''Run a query on the views and return a DataFrame'''
+        if self.__connection is None:
+            self.__connection = duckdb.connect()
+            create_views(self.__connection, self.root)
+        self.logger.debug('duckdb: %s', query)
+        with self.profiler.timed('duckdb', query, args):
+            return self.__connection.execute(query, args).df()
+
+    def _files(self, table, start_date, end_date):
+        years = range(pd.Timestamp(start_date).year, pd.Timestamp(end_date).year + 1)
+        return [f for year in years for f in glob.glob(os.path.join(self.root, table, '*', f'year={year}', '*.parquet'))]
+
+    # storage methods used by the analyzer, see storage.py
+
+    def market_id(self, alias):
+        return int(self._query('SELECT id FROM markets WHERE alias = ?', [alias])['id'].iloc[0])
+
+    def get_companies(self):
+        return self._query('SELECT id, name, mid, symbol, pea FROM companies ORDER BY id')
+
+    def write_companies(self, companies_df):
+        df = companies_df.rename(columns={'cid': 'id'})[['id', 'name', 'mid', 'symbol', 'pea']]
+        self._write(df.astype({'id': np.int16, 'mid': np.int16, 'pea': bool}), 'companies')
+
+    def write_ticks(self, stocks_df, mid):
+        # the statistics of stocksummary are computed by its view
+        self._write_partitions(stocks_df, 'stocks', np.full(len(stocks_df), mid))
+
+    def aggregate_days(self, start_date, end_date, cids=None, workers=None):
+        # one query, DuckDB already uses all the cores
+        only_cids = '' if cids is None else 'AND cid IN (SELECT unnest(?::SMALLINT[]))'
+        args = [start_date, end_date] + ([] if cids is None else [[int(c) for c in cids]])
+        # one row per company and day as on Timescale, even when its symbol is on several markets.
+        # It goes in the partition of the market of the company, or of its ticks when the
+        # company is not written yet
+        days = self._query(f'''
+            SELECT date_trunc('day', s.date) AS date, s.cid, coalesce(any_value(c.mid), min(s.mid)) AS mid,
+                   arg_min(s.value, s.date) AS open, arg_max(s.value, s.date) AS close,
+                   max(s.value) AS high, min(s.value) AS low, sum(s.volume) AS volume
+            FROM read_parquet('{self.root}/stocks/*/*/*.parquet', hive_partitioning = true) s
+            LEFT JOIN companies c ON c.id = s.cid
+            WHERE s.date BETWEEN ?::timestamp AND ?::timestamp {only_cids.replace('cid', 's.cid', 1)}
+            GROUP BY 1, 2
+            ORDER BY 1, 2''', args)
+        # the days computed again (watch, reload) replace their previous rows
+        self._delete_rows('daystocks', cids, pd.Timestamp(start_date).normalize(), pd.Timestamp(end_date))
+        if len(days):
+            self._write_partitions(days.drop(columns=['mid']), 'daystocks', days['mid'])
+        for table in ('stocks', 'daystocks'):
+            self._compact(table, start_date, end_date)
+        return []
+
+    def get_ticks(self, cids, start_date, end_date):
+        return self._query('''
+            SELECT date, cid, value, volume FROM stocks
+            WHERE cid IN (SELECT unnest(?::SMALLINT[])) AND date >= ?::timestamp AND date <= ?::timestamp
+            ORDER BY cid, date''', [[int(c) for c in cids], start_date, end_date])
+
+    def get_daystocks(self, cids, start_date, end_date):
+        return self._query('''
+            SELECT date, cid, open, close, high, low, volume FROM daystocks
+            WHERE cid IN (SELECT unnest(?::SMALLINT[])) AND date >= ?::timestamp AND date <= ?::timestamp
+            ORDER BY cid, date''', [[int(c) for c in cids], start_date, end_date])
+
+    def get_ohlcv(self, cids, start_date, end_date, interval):
+        tables = storage.bar_tables(interval)
+        # no hourly bars here, all the ticks are kept
+        rows = ('SELECT date, cid, value AS open, value AS close, value AS high, value AS low, volume FROM stocks'
+                if 'stocks' in tables else 'SELECT date, cid, open, close, high, low, volume FROM daystocks')
+        return storage.ohlcv_frame(self._query(f'''
+            SELECT time_bucket(?::INTERVAL, date) AS date, cid,
+                   arg_min(open, date) AS open, arg_max(close, date) AS close,
+                   max(high) AS high, min(low) AS low, sum(volume) AS volume
+            FROM ({rows}) bars
+            WHERE cid IN (SELECT unnest(?::SMALLINT[])) AND date >= ?::timestamp AND date <= ?::timestamp
+            GROUP BY 1, 2
+            ORDER BY cid, date''', [str(interval), [int(c) for c in cids], start_date, end_date]))
+
+    def delete_range(self, cids, start_date, end_date, dates=None, ticks_only=False):
+        '''
+        Rewrite the files of the years of [start_date, end_date] without the rows
+        of the companies on these days. dayreturns is a view, nothing to delete.
+        '''
+        first, last = pd.Timestamp(start_date), pd.Timestamp(end_date) + pd.Timedelta(days=1)
+        deleted = {'stocks': self._delete_rows('stocks', cids, first, last, inclusive=False, dates=dates)}
+        if not ticks_only:
+            deleted['daystocks'] = self._delete_rows('daystocks', cids, first, last, inclusive=False)
+        return deleted
+
+    def _delete_rows(self, table, cids, first, last, inclusive=True, dates=None):
+        '''
+        Rewrite the files of a table without the rows of some companies (all if None) from first to last
+
+        :param dates: only the rows at these timestamps
+        '''
+        deleted = 0
+        for filename in self._files(table, first, last):
+            if not self._may_hold(filename, first, last, dates):
+                continue
+            df = pd.read_parquet(filename)
+            dates_of_rows = pd.to_datetime(df['date'])
+            removed = (dates_of_rows >= first).to_numpy() & \
+                ((dates_of_rows <= last) if inclusive else (dates_of_rows < last)).to_numpy()
+            if cids is not None:
+                removed &= df['cid'].isin(cids).to_numpy()
+            if dates is not None:
+                removed &= dates_of_rows.isin(pd.to_datetime(list(dates))).to_numpy()
+            if removed.any():
+                with self.profiler.timed('write_parquet', None):
+                    df[~removed].to_parquet(filename + '.tmp', index=False)
+                    os.replace(filename + '.tmp', filename)
+                deleted += int(removed.sum())
+        return deleted
+
+    def _compact(self, table, start_date, end_date):
+        '''
+        Merge the files of the partitions of the years of [start_date, end_date] which have more than COMPACT_FILES
+
+        The merged file is written first, then compact.json lists the files it
+        replaces, they are removed and the merged file is renamed. A merge stopped
+        half way is finished from compact.json by the next _setup_database.
+        '''
+        for directory in sorted({os.path.dirname(f) for f in self._files(table, start_date, end_date)}):
+            files = sorted(glob.glob(os.path.join(directory, '*.parquet')))
+            if len(files) <= COMPACT_FILES:
+                continue
+            df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True).sort_values(['date', 'cid'])
+            target = os.path.join(directory, f'{os.getpid()}-{uuid.uuid4().hex}.parquet')
+            with self.profiler.timed('write_parquet', None):
+                df.to_parquet(target + '.tmp', index=False)
+            journal = os.path.join(directory, 'compact.json')
+            with open(journal + '.tmp', 'w') as f:
+                json.dump({'target': os.path.basename(target), 'files': [os.path.basename(f) for f in files]}, f)
+            os.replace(journal + '.tmp', journal)
+            self._finish_compact(journal)
+
+    @staticmethod
+    def _finish_compact(journal):
+        directory = os.path.dirname(journal)
+        with open(journal) as f:
+            compact = json.load(f)
+        target = os.path.join(directory, compact['target'])
+        if os.path.exists(target + '.tmp'):
+            for name in compact['files']:
+                if os.path.exists(os.path.join(directory, name)):
+                    os.remove(os.path.join(directory, name))
+            os.replace(target + '.tmp', target)
+        os.remove(journal)
+
+    @staticmethod
+    def _may_hold(filename, first, last, dates=None):
+        '''False when the date statistics of a file show it has no row from first to last (or at dates)'''
+        metadata = pq.read_metadata(filename)
+        column = metadata.schema.names.index('date')
+        dates = None if dates is None else np.sort(pd.to_datetime(list(dates)).to_numpy())
+        for i in range(metadata.num_row_groups):
+            statistics = metadata.row_group(i).column(column).statistics
+            if statistics is None or not statistics.has_min_max:
+                return True
+            low, high = pd.Timestamp(statistics.min), pd.Timestamp(statistics.max)
+            if dates is None:
+                if low <= last and high >= first:
+                    return True
+            elif np.searchsorted(dates, low.to_datetime64()) < np.searchsorted(dates, high.to_datetime64(), side='right'):
+                return True
+        return False
+
+    def rebuild_summary(self, cids, start_date, end_date):
+        # stocksummary is a view on stocks, always up to date
+        pass
+
+    def set_raw_retention(self, raw_retention):
+        if raw_retention:
+            self.logger.info(f"||||| raw retention {raw_retention} ignored, Parquet keeps all the ticks")
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Timing of the SQL queries of the analyzer.
+
+  Every query sent by TimescaleStockMarketModel is timed and counted under
+  the stage of the analyzer running it (store_files, process_data,
+  witchcraft...). The stage is set with
+
+      with profiling.stage('witchcraft'):
+          ...
+
+  Each (stage, kind of call) keeps a latency histogram. Queries slower than
+  the threshold get their plan captured with EXPLAIN (ANALYZE, BUFFERS), or
+  with a plain EXPLAIN when they write, so that an unindexed scan shows up.
+  EXPLAIN ANALYZE runs the query again, so a statement is explained once per
+  stage, its next slow runs are listed without a plan.
+
+  >>> p = QueryProfiler(slow=10)
+  >>> with stage('doctest'):
+  ...     p.record('raw_query', 'SELECT 1', None, 0.002)
+  >>> p.report()['stats'][0]['stage'], p.report()['stats'][0]['count']
+  ('doctest', 1)
+'''
+
+import bisect
+import contextlib
+import json
+import logging
+import re
+import threading
+import time
+
+SLOW_QUERY = 1.0  # seconds, slower queries are explained
+MAX_SLOW_QUERIES = 50  # plans kept
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)  # upper bounds of the histogram in seconds
+
+_local = threading.local()
+_read_only = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+_writes = re.compile(r'\b(INSERT|UPDATE|DELETE|CREATE|DROP|ALTER|TRUNCATE)\b', re.IGNORECASE)
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''Tag the queries sent in this block (and in this thread) with name'''
+    previous = getattr(_local, 'stage', None)
+    _local.stage = name
+    try:
+        yield
+    finally:
+        _local.stage = previous
+
+
+def current_stage():
+    return getattr(_local, 'stage', None) or 'unknown'
+
+
+def explain_statement(query):
+    '''EXPLAIN ANALYZE runs the query, so statements which write are only explained'''
+    if _read_only.match(query) and not _writes.search(query):
+        return 'EXPLAIN (ANALYZE, BUFFERS) ' + query
+    return 'EXPLAIN ' + query
+
+
+class QueryProfiler:
+    """ Latency histograms of the queries per (stage, kind) and plans of the slow ones."""
+
+    def __init__(self, slow=SLOW_QUERY, explain=None):
+        '''
+        slow    -- threshold in seconds above which a query is explained
+        explain -- explain(statement, args) runs an EXPLAIN statement and returns its lines
+        '''
+        self.slow = slow
+        self.__explain = explain
+        self.__lock = threading.Lock()
+        self.__stats = {}  # (stage, kind) -> [count, total, max, histogram]
+        self.__slow_queries = []
+        self.__explained = set()  # (stage, statement) whose plan was captured
+
+    @contextlib.contextmanager
+    def timed(self, kind, query, args=None, explain=None):
+        '''
+        Time the block
+
+        :param explain: explain function of the connection running the query, the one of the profiler if None
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, query, args, time.perf_counter() - start, explain)
+
+    def record(self, kind, query, args, duration, explain=None):
+        if getattr(_local, 'explaining', False):
+            return
+        key = (current_stage(), kind)
+        with self.__lock:
+            stats = self.__stats.setdefault(key, [0, 0.0, 0.0, [0] * (len(BUCKETS) + 1)])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3][bisect.bisect_left(BUCKETS, duration)] += 1
+        if duration > self.slow and isinstance(query, str):
+            self._capture(key, query, args, duration, explain or self.__explain)
+
+    def _capture(self, key, query, args, duration, explain):
+        plan = None
+        with self.__lock:
+            first = (key[0], query) not in self.__explained
+            self.__explained.add((key[0], query))
+        if explain is not None and first:
+            _local.explaining = True  # the EXPLAIN itself is not recorded
+            try:
+                plan = explain(explain_statement(query), args)
+            except Exception as e:
+                plan = ['EXPLAIN failed: %s' % e]
+            finally:
+                _local.explaining = False
+        with self.__lock:
+            self.__slow_queries.append({'stage': key[0], 'kind': key[1], 'seconds': round(duration, 4),
+                                        'query': query, 'plan': plan})
+            del self.__slow_queries[:-MAX_SLOW_QUERIES]
+
+    def report(self):
+        '''Statistics as a JSON compatible dict, slowest stages first'''
+        with self.__lock:
+            stats = [{'stage': stage, 'kind': kind, 'count': count, 'total': round(total, 4),
+                      'mean': round(total / count, 4), 'max': round(longest, 4),
+                      'histogram': dict(zip(['<=%gs' % b for b in BUCKETS] + ['>%gs' % BUCKETS[-1]], histogram))}
+                     for (stage, kind), (count, total, longest, histogram) in self.__stats.items()]
+            slow_queries = list(self.__slow_queries)
+        stats.sort(key=lambda s: s['total'], reverse=True)
+        return {'slow_threshold': self.slow, 'stats': stats, 'slow_queries': slow_queries}
+
+    def log_report(self, logger, level=logging.INFO):
+        report = self.report()
+        for s in report['stats']:
+            logger.log(level, f"|| SQL {s['stage']} {s['kind']} | {s['count']} queries | "
+                              f"{s['total']} s total | {s['mean']} s mean | {s['max']} s max ||")
+        for q in report['slow_queries']:
+            logger.log(level, f"|| slow SQL {q['stage']} {q['kind']} {q['seconds']} s: {q['query']} ||")
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+
+    def reset(self):
+        with self.__lock:
+            self.__stats.clear()
+            self.__slow_queries.clear()
+            self.__explained.clear()
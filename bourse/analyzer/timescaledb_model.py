@@ -3,14 +3,62 @@
 # TimeScaleDB
 # pipenv install sqlalchemy-timescaledb
 
+import concurrent.futures
 import datetime
+import functools
+import time
+import numpy as np
 import psycopg2
+import psycopg2.extras
 import pandas as pd
 import sqlalchemy
 
 import mylogging
+import profiling
+import storage
 
-class TimescaleStockMarketModel:
+AGGREGATE_WORKERS = 4  # connections computing daystocks at the same time, see aggregate_days
+AGGREGATE_RETRIES = 2  # retries of a month which failed
+
+
+# rows of each table as bars, the ticks are bars of one tick
+BARS = {
+    'stocks': 'SELECT date, cid, value AS open, value AS close, value AS high, value AS low, volume FROM stocks',
+    'hourstocks': 'SELECT date, cid, open, close, high, low, volume FROM hourstocks',
+    'daystocks': 'SELECT date, cid, open, close, high, low, volume FROM daystocks',
+}
+
+
+def ohlcv_query(tables, before='<=', only_cids=''):
+    '''
+    SELECT of the bars (date, cid, open, close, high, low, volume) of %(interval)s on
+    [%(start)s, %(end)s] ([%(start)s, %(end)s) with before='<') from the rows of some tables of BARS
+
+    Buckets start at midnight in the time zone of the session, as date_trunc('day', ...).
+    '''
+    rows = '\n      UNION ALL\n      '.join(f"{BARS[table]} WHERE date >= %(start)s AND date {before} %(end)s {only_cids}"
+                                          for table in tables)
+    return f'''
+    SELECT time_bucket(%(interval)s::interval, date, current_setting('timezone')) AS date, cid,
+           first(open, date) AS open, last(close, date) AS close,
+           max(high) AS high, min(low) AS low, sum(volume) AS volume
+    FROM ({rows}) bars
+    GROUP BY 1, 2'''
+
+
+def month_partitions(start_date, end_date):
+    '''
+    Cut [start_date, end_date] by month: list of (start, end, last), end is excluded but for the last one
+
+    >>> month_partitions('2023-01-15', '2023-03-31')
+    [('2023-01-15 00:00:00', '2023-02-01 00:00:00', False), ('2023-02-01 00:00:00', '2023-03-01 00:00:00', False), ('2023-03-01 00:00:00', '2023-03-31 00:00:00', True)]
+    '''
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    bounds = [start] + [m for m in pd.date_range(start, end, freq='MS') if m > start]
+    return [(str(a), str(b), False) for a, b in zip(bounds, bounds[1:])] + [(str(bounds[-1]), str(end), True)]
+
+
+class TimescaleStockMarketModel(storage.StockMarketStorage):
     """ Bourse model with TimeScaleDB persistence."""
 
     def __init__(self, database, user=None, host=None, password=None, port=None, is_thread=False):
@@ -38,8 +86,9 @@ class TimescaleStockMarketModel:
         self.__nf_cid = {}  # cid from netfonds symbol
         self.__boursorama_cid = {}  # cid from netfonds symbol
         self.__market_id = {}  # id of markets from aliases
+        # timing of every query, tagged with the analyzer stage (see profiling.stage)
+        self.profiler = profiling.QueryProfiler(explain=self._explain)
 
-        self.logger.info("Setup database generates an error if it exists already, it's ok")
         if not is_thread:
             self._setup_database()
 
@@ -53,6 +102,12 @@ class TimescaleStockMarketModel:
             #   create schema public;
             #
             cursor = self.__connection.cursor()
+            cursor.execute("SELECT to_regclass('markets')")
+            if cursor.fetchone()[0] is not None:
+                # already set up, only the derived tables may be missing
+                self.__connection.commit()
+                self._setup_derived_tables()
+                return
             # markets (see end for list of makets)
             cursor.execute('''CREATE SEQUENCE market_id_seq START 1;''')
             cursor.execute(
@@ -120,21 +175,139 @@ class TimescaleStockMarketModel:
             cursor.execute("INSERT INTO markets (id, name, alias) VALUES (9,'Bourse Allemande','xetra');")
             cursor.execute("INSERT INTO markets (id, name, alias) VALUES (10,'Bruxelle','bruxelle');")
         except Exception as e:
-            self.logger.exception('SQL error: %s' % e)
+            self.logger.exception('SQL error: %s', e)
+        self.__connection.commit()
+        self._setup_derived_tables()
+
+    def _setup_derived_tables(self):
+        # Tables computed from stocks and daystocks by the analyzer. They are
+        # created with IF NOT EXISTS so they are added to an existing database.
+        try:
+            cursor = self.__connection.cursor()
+            # stocksummary: per company and per year
+            #   - ticks, value_sum, low, high : from the rows of stocks (mean = value_sum / ticks)
+            #   - days : number of rows in daystocks
+            cursor.execute(
+                '''CREATE TABLE IF NOT EXISTS stocksummary (
+                  cid SMALLINT,
+                  year SMALLINT,
+                  first_date TIMESTAMPTZ,
+                  last_date TIMESTAMPTZ,
+                  ticks INTEGER,
+                  days INTEGER DEFAULT 0,
+                  low FLOAT4,
+                  high FLOAT4,
+                  value_sum FLOAT8,
+                  volume BIGINT,
+                  PRIMARY KEY (cid, year)
+                );''')
+            # same per company, all years together
+            cursor.execute(
+                '''CREATE OR REPLACE VIEW companysummary AS
+                  SELECT cid, min(first_date) AS first_date, max(last_date) AS last_date,
+                         sum(ticks) AS ticks, sum(days) AS days, min(low) AS low, max(high) AS high,
+                         sum(value_sum) / NULLIF(sum(ticks), 0) AS mean, sum(volume) AS volume
+                  FROM stocksummary
+                  GROUP BY cid;''')
+            # dayreturns: one row per daystocks row with the market of the company
+            #   - ret : close / previous close - 1
+            #   - volume_ratio : volume / average volume of the 20 previous days
+            cursor.execute(
+                '''CREATE TABLE IF NOT EXISTS dayreturns (
+                  date TIMESTAMPTZ,
+                  cid SMALLINT,
+                  mid SMALLINT,
+                  close FLOAT4,
+                  ret FLOAT4,
+                  volume BIGINT,
+                  volume_ratio FLOAT4
+                );''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS idx_mid_date_dayreturns ON dayreturns (mid, date, cid);''')
+            cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_cid_date_dayreturns ON dayreturns (cid, date);''')
+            # marketindex: one row per market and day, computed from dayreturns
+            #   - equal_ret : mean of the returns of the companies of the market
+            #   - volume_ret : mean of the returns weighted by the volume of the day
+            # the index itself is the cumulated product of (1 + ret), computed by the dashboard
+            cursor.execute(
+                '''CREATE TABLE IF NOT EXISTS marketindex (
+                  date TIMESTAMPTZ,
+                  mid SMALLINT,
+                  companies SMALLINT,
+                  volume BIGINT,
+                  equal_ret FLOAT8,
+                  volume_ret FLOAT8
+                );''')
+            cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_mid_date_marketindex ON marketindex (mid, date);''')
+            # hourstocks: stocks rows older than the raw retention, one row per company and hour
+            # (see set_raw_retention). A tick is either in stocks or in hourstocks, never both.
+            #   - ticks, value_sum : to compute again stocksummary and means
+            cursor.execute(
+                '''CREATE TABLE IF NOT EXISTS hourstocks (
+                  date TIMESTAMPTZ,
+                  cid SMALLINT,
+                  open FLOAT4,
+                  close FLOAT4,
+                  high FLOAT4,
+                  low FLOAT4,
+                  volume BIGINT,
+                  ticks INTEGER,
+                  value_sum FLOAT8
+                );''')
+            cursor.execute('''SELECT create_hypertable('hourstocks', by_range('date'), if_not_exists => TRUE);''')
+            cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_cid_date_hourstocks ON hourstocks (cid, date DESC);''')
+            # Job of the retention: the chunks of stocks older than the newest tick minus
+            # config->>'raw_retention' are rolled into hourstocks then dropped, one chunk per
+            # transaction. A chunk is kept while one of its days is missing in daystocks.
+            cursor.execute(
+                '''CREATE OR REPLACE PROCEDURE stocks_retention(job_id INTEGER, config JSONB)
+                LANGUAGE plpgsql AS $$
+                DECLARE
+                  horizon TIMESTAMPTZ;
+                  chunk RECORD;
+                BEGIN
+                  SELECT max(date) - (config->>'raw_retention')::INTERVAL INTO horizon FROM stocks;
+                  IF horizon IS NULL THEN
+                    RETURN;
+                  END IF;
+                  FOR chunk IN SELECT range_start, range_end FROM timescaledb_information.chunks
+                               WHERE hypertable_name = 'stocks' AND range_end <= horizon
+                               ORDER BY range_start LOOP
+                    CONTINUE WHEN EXISTS (
+                      SELECT 1
+                      FROM (SELECT DISTINCT cid, date_trunc('day', date) AS day FROM stocks
+                            WHERE date >= chunk.range_start AND date < chunk.range_end) s
+                      WHERE NOT EXISTS (SELECT 1 FROM daystocks d WHERE d.cid = s.cid AND d.date = s.day));
+                    INSERT INTO hourstocks AS h (date, cid, open, close, high, low, volume, ticks, value_sum)
+                    SELECT time_bucket('1 hour', date), cid, first(value, date), last(value, date),
+                           max(value), min(value), sum(volume), count(*), sum(value::FLOAT8)
+                    FROM stocks
+                    WHERE date >= chunk.range_start AND date < chunk.range_end
+                    GROUP BY 1, 2
+                    ON CONFLICT (cid, date) DO UPDATE SET
+                      open = EXCLUDED.open, close = EXCLUDED.close, high = EXCLUDED.high, low = EXCLUDED.low,
+                      volume = EXCLUDED.volume, ticks = EXCLUDED.ticks, value_sum = EXCLUDED.value_sum;
+                    PERFORM drop_chunks('stocks', older_than => chunk.range_end, newer_than => chunk.range_start);
+                    COMMIT;
+                  END LOOP;
+                END
+                $$;''')
+        except Exception as e:
+            self.logger.exception('SQL error: %s', e)
         self.__connection.commit()
 
     # ------------------------------ public methods --------------------------------
 
     def execute(self, query, args=None, cursor=None, commit=False):
         """Send a Postgres SQL command. No return"""
+        # the message is only built when debug is on
         if args is None:
-            pretty = query
+            self.logger.debug('SQL: QUERY: %s', query)
         else:
-            pretty = '%s %% %r' % (query, args)
-        self.logger.debug('SQL: QUERY: %s' % pretty)
+            self.logger.debug('SQL: QUERY: %s %% %r', query, args)
         if cursor is None:
             cursor = self.__connection.cursor()
-        cursor.execute(query, args)
+        with self.profiler.timed('execute', query, args):
+            cursor.execute(query, args)
         if commit:
             self.commit()
         try:
@@ -158,9 +331,10 @@ class TimescaleStockMarketModel:
         :param other args: see https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.to_sql.html
         '''
         self.logger.debug('df_write')
-        df.to_sql(table, self.__engine,
-                  if_exists=if_exists, index=index, index_label=index_label,
-                  chunksize=chunksize, dtype=dtype, method=method)
+        with self.profiler.timed('df_write', None):
+            df.to_sql(table, self.__engine,
+                      if_exists=if_exists, index=index, index_label=index_label,
+                      chunksize=chunksize, dtype=dtype, method=method)
         if commit:
             self.commit()
 
@@ -168,14 +342,15 @@ class TimescaleStockMarketModel:
 
     def raw_query(self, query, args=None, cursor=None):
         """Return a tuple from a Postgres SQL query"""
+        # the message is only built when debug is on
         if args is None:
-            pretty = query
+            self.logger.debug('SQL: QUERY: %s', query)
         else:
-            pretty = '%s %% %r' % (query, args)
-        self.logger.debug('SQL: QUERY: %s' % pretty)
+            self.logger.debug('SQL: QUERY: %s %% %r', query, args)
         if cursor is None:
             cursor = self.__connection.cursor()
-        cursor.execute(query, args)
+        with self.profiler.timed('raw_query', query, args):
+            cursor.execute(query, args)
         return cursor.fetchall()
 
     def df_query(self, query, args=None, index_col=None, coerce_float=True, params=None, 
@@ -189,10 +364,30 @@ class TimescaleStockMarketModel:
         '''
         if args is not None:
             query = query % args
-        self.logger.debug('df_query: %s' % query)
-        return pd.read_sql(query, self.__engine, index_col=index_col, coerce_float=coerce_float, 
-                           params=params, parse_dates=parse_dates, columns=columns, 
-                           chunksize=chunksize, dtype=dtype)
+        self.logger.debug('df_query: %s', query)
+        # with a chunksize only the first fetch is timed, the rest is read by the caller
+        with self.profiler.timed('df_query', query, params):
+            return pd.read_sql(query, self.__engine, index_col=index_col, coerce_float=coerce_float, 
+                               params=params, parse_dates=parse_dates, columns=columns, 
+                               chunksize=chunksize, dtype=dtype)
+
+    def _explain(self, statement, args=None, connection=None):
+        '''
+        Run an EXPLAIN statement for the profiler and return the lines of the plan
+
+        :param connection: the connection of the query (in its transaction), the main one if None
+        '''
+        cursor = (connection or self.__connection).cursor()
+        # a failing EXPLAIN must not abort the transaction of the caller
+        cursor.execute('SAVEPOINT profiler_explain')
+        try:
+            cursor.execute(statement, args)
+            return [row[0] for row in cursor.fetchall()]
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT profiler_explain')
+            raise
+        finally:
+            cursor.execute('RELEASE SAVEPOINT profiler_explain')
 
     # system methods
 
@@ -257,6 +452,290 @@ class TimescaleStockMarketModel:
         else:
             return 0
 
+    def update_summary(self, stocks_df, commit=True):
+        '''
+        Add a batch of stocks rows to the stocksummary table
+
+        :param stocks_df: DataFrame with date, cid, value and volume columns, as written in stocks
+        '''
+        if len(stocks_df) == 0:
+            return
+        dates = pd.to_datetime(stocks_df['date'])
+        batch = pd.DataFrame({'cid': stocks_df['cid'].to_numpy(), 'year': dates.dt.year.to_numpy(),
+                              'date': dates.to_numpy(), 'value': stocks_df['value'].to_numpy(dtype=np.float64),
+                              'volume': stocks_df['volume'].to_numpy()})
+        stats = batch.groupby(['cid', 'year']).agg(first_date=('date', 'min'), last_date=('date', 'max'),
+                                                   ticks=('value', 'size'), low=('value', 'min'),
+                                                   high=('value', 'max'), value_sum=('value', 'sum'),
+                                                   volume=('volume', 'sum'))
+        # sorted by key so that concurrent workers lock the rows in the same order
+        rows = [(int(cid), int(year), first.to_pydatetime(), last.to_pydatetime(), int(ticks),
+                 float(low), float(high), float(value_sum), int(volume))
+                for (cid, year), first, last, ticks, low, high, value_sum, volume
+                in zip(stats.index, stats['first_date'], stats['last_date'],
+                       stats['ticks'], stats['low'], stats['high'], stats['value_sum'], stats['volume'])]
+        self.logger.debug('update_summary: %d rows', len(rows))
+        cursor = self.__connection.cursor()
+        with self.profiler.timed('execute_values', None):
+            psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO stocksummary AS s (cid, year, first_date, last_date, ticks, low, high, value_sum, volume)
+                VALUES %s
+                ON CONFLICT (cid, year) DO UPDATE SET
+                  first_date = LEAST(s.first_date, EXCLUDED.first_date),
+                  last_date = GREATEST(s.last_date, EXCLUDED.last_date),
+                  ticks = s.ticks + EXCLUDED.ticks,
+                  low = LEAST(s.low, EXCLUDED.low),
+                  high = GREATEST(s.high, EXCLUDED.high),
+                  value_sum = s.value_sum + EXCLUDED.value_sum,
+                  volume = s.volume + EXCLUDED.volume''', rows)
+        if commit:
+            self.commit()
+
+    def update_summary_days(self, start_date, end_date, cids=None, commit=True):
+        '''
+        Count the daystocks rows of the years of [start_date, end_date] in stocksummary
+
+        :param cids: only these companies (with the (cid, date) index), all of them if None
+        '''
+        args = {'start': start_date, 'end': end_date, 'cids': None if cids is None else [int(c) for c in cids]}
+        only_cids = '' if cids is None else 'AND cid = ANY(%(cids)s)'
+        self.execute(f'''
+            UPDATE stocksummary s SET days = d.days
+            FROM (SELECT cid, extract(year FROM date)::smallint AS year, count(*) AS days
+                  FROM daystocks
+                  WHERE date >= date_trunc('year', %(start)s::timestamptz)
+                    AND date < date_trunc('year', %(end)s::timestamptz) + interval '1 year' {only_cids}
+                  GROUP BY 1, 2) d
+            WHERE s.cid = d.cid AND s.year = d.year''', args, commit=commit)
+
+    def update_day_returns(self, start_date, end_date, cids=None, commit=True):
+        '''
+        Compute the dayreturns rows of [start_date, end_date] from daystocks
+
+        The days just after end_date are computed again too, as their previous
+        day may have been loaded only now (years are loaded from the last one).
+
+        :param cids: only these companies, all of them if None
+        '''
+        args = {'start': start_date, 'end': end_date, 'cids': None if cids is None else [int(c) for c in cids]}
+        only_cids = '' if cids is None else 'AND cid = ANY(%(cids)s)'
+        only_day_cids = '' if cids is None else 'AND d.cid = ANY(%(cids)s)'
+        self.execute('''
+            DELETE FROM dayreturns
+            WHERE date >= %(start)s::timestamptz AND date < %(end)s::timestamptz + interval '8 days' ''' + only_cids,
+                     args)
+        self.execute('''
+            INSERT INTO dayreturns (date, cid, mid, close, ret, volume, volume_ratio)
+            SELECT date, cid, mid, close, ret, volume, volume_ratio
+            FROM (SELECT d.date, d.cid, c.mid, d.close, d.volume,
+                         d.close / NULLIF(lag(d.close) OVER w, 0) - 1 AS ret,
+                         d.volume / NULLIF(avg(d.volume) OVER (w ROWS BETWEEN 20 PRECEDING AND 1 PRECEDING), 0) AS volume_ratio
+                  FROM daystocks d JOIN companies c ON c.id = d.cid
+                  WHERE d.date >= %(start)s::timestamptz - interval '40 days'
+                    AND d.date < %(end)s::timestamptz + interval '8 days' ''' + only_day_cids + '''
+                  WINDOW w AS (PARTITION BY d.cid ORDER BY d.date)) r
+            WHERE date >= %(start)s::timestamptz''', args, commit=commit)
+
+    def update_market_index(self, start_date, end_date, commit=True):
+        '''
+        Compute the marketindex rows of [start_date, end_date] from dayreturns, for every market
+
+        Same days as update_day_returns, its rows of the days after end_date may have changed.
+        '''
+        args = {'start': start_date, 'end': end_date}
+        self.execute('''
+            DELETE FROM marketindex
+            WHERE date >= %(start)s::timestamptz AND date < %(end)s::timestamptz + interval '8 days' ''', args)
+        self.execute('''
+            INSERT INTO marketindex (date, mid, companies, volume, equal_ret, volume_ret)
+            SELECT date, mid, count(*), sum(volume), avg(ret), sum(ret * volume) / NULLIF(sum(volume), 0)
+            FROM dayreturns
+            WHERE date >= %(start)s::timestamptz AND date < %(end)s::timestamptz + interval '8 days' AND ret > -1
+            GROUP BY date, mid''', args, commit=commit)
+
+    # storage methods used by the analyzer, see storage.py
+
+    def market_id(self, alias):
+        if alias not in self.__market_id:
+            self.__market_id[alias] = int(self.raw_query("SELECT id FROM markets WHERE alias = %s", (alias,))[0][0])
+        return self.__market_id[alias]
+
+    def write_companies(self, companies_df, commit=True):
+        self.df_write(companies_df.rename(columns={'cid': 'id'}), 'companies', index=False)
+        # the ids are given by the analyzer, the sequence goes on after them
+        self.execute("SELECT setval('company_id_seq', (SELECT max(id) FROM companies))", commit=commit)
+
+    def write_ticks(self, stocks_df, mid=None):
+        self.df_write(stocks_df, 'stocks', commit=True, index=False)
+        # Keep per company and per year statistics up to date with this batch
+        self.update_summary(stocks_df)
+
+    def aggregate_days(self, start_date, end_date, cids=None, workers=None):
+        '''
+        The range is cut by month, each month is aggregated on its own connection,
+        workers months at a time. A month replaces its daystocks rows in one
+        transaction, so a failed month is retried alone (AGGREGATE_RETRIES times).
+
+        :return: the (start, end) of the months which failed
+        '''
+        partitions = month_partitions(start_date, end_date)
+        stage = profiling.current_stage()
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or AGGREGATE_WORKERS) as pool:
+            futures = {pool.submit(self._aggregate_partition, start, end, last, cids, stage): (start, end)
+                       for start, end, last in partitions}
+            for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                start, end = futures[future]
+                try:
+                    rows, seconds = future.result()
+                    self.logger.info(f"||||| aggregate_days {start}/{end}: {rows} rows in {round(seconds, 2)} s ({done}/{len(partitions)})")
+                except Exception as e:
+                    self.logger.error(f"||||| aggregate_days {start}/{end} failed: {e} ({done}/{len(partitions)})")
+                    failed.append((start, end))
+        self.update_summary_days(start_date, end_date, cids=cids)
+        # Daily returns and volume ratios used by the dashboard screener
+        self.update_day_returns(start_date, end_date, cids=cids)
+        # Market indexes of the dashboard, all the companies of a market count on a day
+        self.update_market_index(start_date, end_date)
+        return sorted(failed)
+
+    def _connect(self):
+        return psycopg2.connect(database=self.__database, user=self.__user, host=self.__host,
+                                port=self.__port, password=self.__password)
+
+    def _aggregate_partition(self, start, end, last, cids, stage):
+        '''Replace the daystocks rows of [start, end) ([start, end] for the last one), return (rows, seconds)'''
+        before = '<=' if last else '<'
+        only_cids = "" if cids is None else "AND d.cid = ANY(%(cids)s)"
+        only_tick_cids = "" if cids is None else "AND cid = ANY(%(cids)s)"
+        args = {'start': start, 'end': end, 'cids': None if cids is None else [int(c) for c in cids], 'interval': '1 day'}
+        # days whose ticks were rolled into hourstocks are kept, they cannot be computed again
+        delete = f"""
+        DELETE FROM daystocks d
+        WHERE date >= date_trunc('day', %(start)s::timestamptz) AND date {before} %(end)s {only_cids}
+          AND EXISTS (SELECT 1 FROM stocks s
+                      WHERE s.cid = d.cid AND s.date >= d.date AND s.date < d.date + interval '1 day')"""
+        insert = f"""
+        INSERT INTO daystocks (date, cid, open, close, high, low, volume)
+        {ohlcv_query(['stocks'], before, only_tick_cids)}
+        ORDER BY 1, 2;
+        """
+        begin = time.perf_counter()
+        connection = self._connect()
+        try:
+            for attempt in range(AGGREGATE_RETRIES + 1):
+                try:
+                    with profiling.stage(stage):
+                        cursor = connection.cursor()
+                        # the main connection is shared by the threads and outside of this transaction
+                        explain = functools.partial(self._explain, connection=connection)
+                        with self.profiler.timed('aggregate_days', delete, args, explain):
+                            cursor.execute(delete, args)
+                        with self.profiler.timed('aggregate_days', insert, args, explain):
+                            cursor.execute(insert, args)
+                        rows = cursor.rowcount
+                    connection.commit()
+                    return rows, time.perf_counter() - begin
+                except psycopg2.Error as e:
+                    connection.rollback()
+                    if attempt == AGGREGATE_RETRIES:
+                        raise
+                    self.logger.warning(f"||||| aggregate_days {start}/{end} failed, retry {attempt + 1}: {e}")
+        finally:
+            connection.close()
+
+    def get_ticks(self, cids, start_date, end_date):
+        res = self.raw_query('''
+            SELECT date, cid, value, volume FROM stocks
+            WHERE cid = ANY(%s) AND date >= %s AND date <= %s ORDER BY cid, date''',
+                             ([int(c) for c in cids], start_date, end_date))
+        return pd.DataFrame(res, columns=['date', 'cid', 'value', 'volume'])
+
+    def get_daystocks(self, cids, start_date, end_date):
+        res = self.raw_query('''
+            SELECT date, cid, open, close, high, low, volume FROM daystocks
+            WHERE cid = ANY(%s) AND date >= %s AND date <= %s ORDER BY cid, date''',
+                             ([int(c) for c in cids], start_date, end_date))
+        return pd.DataFrame(res, columns=['date', 'cid', 'open', 'close', 'high', 'low', 'volume'])
+
+    def get_ohlcv(self, cids, start_date, end_date, interval):
+        '''
+        Bars of some companies at any interval, see storage.py
+
+        Whole days are computed from daystocks, shorter intervals from stocks and hourstocks.
+        The statement only depends on the interval kind, the values are bound parameters.
+        '''
+        query = ohlcv_query(storage.bar_tables(interval), only_cids='AND cid = ANY(%(cids)s)') + '\n    ORDER BY cid, date'
+        res = self.raw_query(query, {'interval': str(interval), 'start': start_date, 'end': end_date,
+                                     'cids': [int(c) for c in cids]})
+        return storage.ohlcv_frame(res)
+
+    def get_companies(self):
+        '''Return the companies (id, name, mid, symbol, pea) as a DataFrame'''
+        return self.df_query('SELECT id, name, mid, symbol, pea FROM companies ORDER BY id', chunksize=None)
+
+    def delete_range(self, cids, start_date, end_date, dates=None, ticks_only=False, commit=True):
+        '''
+        Remove the stocks, hourstocks, daystocks and dayreturns rows of some companies from start_date to end_date included
+
+        Chunks of the hypertables are cut by date only and hold every market,
+        so rows are deleted by company with the (cid, date) indexes rather than
+        dropping whole chunks.
+
+        :param dates: only the stocks rows at these timestamps (of the files reloaded), all of the range if None
+        :return: dict table -> number of rows deleted
+        '''
+        cids = [int(c) for c in cids]
+        cursor = self.__connection.cursor()
+        deleted = {}
+        for table in ('stocks',) if ticks_only else ('stocks', 'hourstocks', 'daystocks', 'dayreturns'):
+            only_dates = '' if dates is None or table != 'stocks' else 'AND date = ANY(%s::timestamptz[])'
+            self.execute(f'''
+                DELETE FROM {table}
+                WHERE cid = ANY(%s) AND date >= %s::date AND date < %s::date + 1 {only_dates}''',
+                         (cids, start_date, end_date) + (() if not only_dates else (list(dates),)), cursor=cursor)
+            deleted[table] = cursor.rowcount
+        if commit:
+            self.commit()
+        return deleted
+
+    def rebuild_summary(self, cids, start_date, end_date, commit=True):
+        '''Compute again from stocks and hourstocks the stocksummary rows of some companies for the years of [start_date, end_date]'''
+        args = {'cids': [int(c) for c in cids], 'start': start_date, 'end': end_date}
+        self.execute('''
+            DELETE FROM stocksummary
+            WHERE cid = ANY(%(cids)s)
+              AND year BETWEEN extract(year FROM %(start)s::date) AND extract(year FROM %(end)s::date)''', args)
+        # hours rolled by the retention count with their first and last ticks at the hour
+        self.execute('''
+            INSERT INTO stocksummary (cid, year, first_date, last_date, ticks, low, high, value_sum, volume)
+            SELECT cid, extract(year FROM date)::smallint, min(date), max(date), sum(ticks),
+                   min(low), max(high), sum(value_sum), sum(volume)
+            FROM (SELECT cid, date, 1 AS ticks, value AS low, value AS high, value::float8 AS value_sum, volume
+                  FROM stocks
+                  WHERE cid = ANY(%(cids)s)
+                    AND date >= date_trunc('year', %(start)s::timestamptz)
+                    AND date < date_trunc('year', %(end)s::timestamptz) + interval '1 year'
+                  UNION ALL
+                  SELECT cid, date, ticks, low, high, value_sum, volume
+                  FROM hourstocks
+                  WHERE cid = ANY(%(cids)s)
+                    AND date >= date_trunc('year', %(start)s::timestamptz)
+                    AND date < date_trunc('year', %(end)s::timestamptz) + interval '1 year') t
+            GROUP BY 1, 2''', args, commit=commit)
+
+    def set_raw_retention(self, raw_retention):
+        '''
+        Schedule the retention job of stocks (see stocks_retention in _setup_derived_tables)
+
+        :param raw_retention: interval of raw ticks kept before the newest one ('1 year'), None to keep everything
+        '''
+        self.execute("SELECT delete_job(job_id) FROM timescaledb_information.jobs WHERE proc_name = 'stocks_retention'")
+        if raw_retention:
+            self.execute("SELECT add_job('stocks_retention', '1 day', config => jsonb_build_object('raw_retention', %s::text))",
+                         (raw_retention,))
+        self.commit()
+
     def is_file_done(self, name):
         '''
         Check if a file has already been included in the DB
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Market wide analytics computed in bulk with NumPy.
+
+  The daily closes of all the companies of a market are read with one query
+  and pivoted into a dense (day x company) float32 matrix. Returns and the
+  correlation matrix are then computed on the whole matrix at once.
+
+  >>> closes = np.array([[10, 20, 5], [11, 22, 5], [12, 24, 4], [11, 22, 5]], dtype=np.float32)
+  >>> corr, kept = correlation(returns(closes), min_periods=2)
+  >>> np.round(corr, 2)
+  array([[ 1.  ,  1.  , -0.85],
+         [ 1.  ,  1.  , -0.85],
+         [-0.85, -0.85,  1.  ]], dtype=float32)
+'''
+
+import collections
+import threading
+
+import numpy as np
+
+from indicators import ffill
+
+# A company needs at least this number of daily returns to be in the correlation matrix
+MIN_RETURNS = 20
+
+
+def close_matrix(df):
+    '''
+    Pivot a long frame (date, cid, close) into a dense (day x company) matrix
+
+    :return: days (T,) datetime64, cids (N,), closes (T x N) float32, NaN when a company has no row
+    '''
+    df = df.drop_duplicates(['date', 'cid'], keep='last')
+    wide = df.pivot(index='date', columns='cid', values='close').sort_index()
+    return (np.asarray(wide.index, dtype='datetime64[D]'), wide.columns.to_numpy(),
+            wide.to_numpy(dtype=np.float32))
+
+
+def returns(closes):
+    '''Daily log returns (T-1 x N), a missing close is the previous one, NaN before the first close'''
+    filled = ffill(closes).astype(np.float32)
+    with np.errstate(all='ignore'):
+        r = np.diff(np.log(filled), axis=0)
+    r[~np.isfinite(r)] = np.nan
+    return r
+
+
+def correlation(r, min_periods=MIN_RETURNS):
+    '''
+    Correlation matrix of the columns of r, ignoring NaN.
+
+    :return: (K x K) float32 matrix, indexes of the K columns with at least min_periods returns
+
+    Each column is centered and scaled on its own returns, missing returns count
+    as 0 and each product is divided by the number of days both columns have.
+    '''
+    valid = ~np.isnan(r)
+    kept = np.flatnonzero(valid.sum(axis=0) >= min_periods)
+    r = r[:, kept]
+    valid = valid[:, kept].astype(np.float32)
+    with np.errstate(all='ignore'):
+        mean = np.nanmean(r, axis=0)
+        std = np.nanstd(r, axis=0)
+    std[~(std > 0)] = np.nan
+    z = np.nan_to_num((r - mean) / std).astype(np.float32)
+    counts = valid.T @ valid
+    with np.errstate(all='ignore'):
+        corr = (z.T @ z) / counts
+    corr = np.clip(np.nan_to_num(corr), -1, 1).astype(np.float32)
+    np.fill_diagonal(corr, 1)
+    return corr, kept
+
+
+# Correlation of a market on a range: days and cids of the matrix, the
+# correlation matrix and the cids it covers
+MarketCorrelation = collections.namedtuple('MarketCorrelation', 'days cids corr corr_cids')
+
+
+class CorrelationCache:
+    """ Correlation matrices per (market, range), least recently used dropped first, shared by the threads of the server."""
+
+    def __init__(self, max_entries=32):
+        self.__entries = collections.OrderedDict()
+        self.__max_entries = max_entries
+        self.__lock = threading.Lock()  # the callbacks run on several threads
+        self.__computing = {}  # key -> lock held while its matrix is computed
+
+    def _cached(self, key):
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                return self.__entries[key]
+            return None
+
+    def get(self, mid, start_date, end_date, fetch):
+        '''
+        Return the MarketCorrelation of a market on a range, computed on first use
+
+        :param fetch: fetch(mid, start_date, end_date) returns the long frame (date, cid, close)
+        '''
+        key = (int(mid), str(start_date), str(end_date))
+        result = self._cached(key)
+        if result is not None:
+            return result
+        with self.__lock:
+            computing = self.__computing.setdefault(key, threading.Lock())
+        # the callbacks asking for the same matrix wait for the first one
+        with computing:
+            result = self._cached(key)
+            if result is not None:
+                return result
+            try:
+                days, cids, closes = close_matrix(fetch(mid, start_date, end_date))
+                corr, kept = correlation(returns(closes))
+                result = MarketCorrelation(days, cids, corr, cids[kept])
+                with self.__lock:
+                    self.__entries[key] = result
+                    while len(self.__entries) > self.__max_entries:
+                        self.__entries.popitem(last=False)
+            finally:
+                with self.__lock:
+                    self.__computing.pop(key, None)
+        return result
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Latency of the dashboard callbacks, called directly on generated data.
+
+      python benchmark.py                      # all the scenarios, 5 runs each
+      python benchmark.py --repeat 20 --json /tmp/bench.json
+
+  A Parquet dataset (see parquet_model.py in the analyzer) is generated once
+  in --root with synthetic companies and ticks every 10 minutes over several
+  years, then the dashboard is imported on it (BOURSE_DATABASE_URI) and the
+  callbacks are called without the browser:
+
+    - update_graph for 1, 5 and 20 companies, ranges from 1 day to 5 years,
+      line, candlestick and bollinger
+    - update_tab_content, export_csv, filter_companies and update_market_index
+
+  For each scenario: p50 and p95 latency, rows read from the database and
+  size of what is sent to the browser (JSON of the figure or the component).
+  Caches of the dashboard are kept, the first run of a scenario may be the
+  only one paying for a query; it is reported apart.
+
+  pip install duckdb pyarrow duckdb-engine
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ANALYZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analyzer')
+
+COMPANIES = (1, 5, 20)
+RANGES = {'1d': pd.Timedelta(days=1), '1w': pd.Timedelta(weeks=1), '1m': pd.Timedelta(days=31),
+          '1y': pd.Timedelta(days=365), '5y': pd.Timedelta(days=5 * 365)}
+GRAPH_TYPES = ('line', 'candlestick', 'bollinger')
+SEARCHES = ('', 'a', 'co', 'company 1', '1rSYM7')
+
+
+def seed(root, n_companies, years, end_year=2023):
+    '''Write n_companies with ticks every 10 minutes (9h-17h30, business days) over years into root'''
+    marker = os.path.join(root, 'benchmark.json')
+    params = {'companies': n_companies, 'years': years, 'end_year': end_year}
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == params:
+                return
+        raise SystemExit(f"{root} holds another dataset, remove it or use --root")
+
+    sys.path.insert(0, ANALYZER)
+    import parquet_model
+
+    db = parquet_model.ParquetStockMarketModel(root)
+    rng = np.random.default_rng(0)
+    mids = [7, 8, 6]
+    companies = pd.DataFrame({'cid': np.arange(1, n_companies + 1),
+                              'name': [f'Company {i}' for i in range(1, n_companies + 1)],
+                              'mid': [mids[i % len(mids)] for i in range(n_companies)],
+                              'symbol': [f'1rSYM{i}' for i in range(1, n_companies + 1)],
+                              'pea': False})
+    db.write_companies(companies)
+
+    days = pd.bdate_range(f'{end_year - years + 1}-01-01', f'{end_year}-12-31')
+    minutes = pd.timedelta_range('9h', '17h30min', freq='10min')
+    for year in range(end_year - years + 1, end_year + 1):
+        year_days = days[days.year == year]
+        dates = (np.asarray(year_days, dtype='datetime64[ns]')[:, None] + np.asarray(minutes)[None, :]).ravel()
+        for cid, mid in zip(companies['cid'], companies['mid']):
+            steps = rng.normal(0, 0.002, len(dates)).astype(np.float32)
+            values = (50 * np.exp(np.cumsum(steps))).astype(np.float32)
+            db.write_ticks(pd.DataFrame({'date': dates, 'cid': np.int16(cid), 'value': values,
+                                         'volume': rng.integers(0, 5000, len(dates))}), mid)
+        db.aggregate_days(f'{year}-01-01', f'{year}-12-31 23:59:59.999999')
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+
+
+class RowCounter:
+    """ Counts the rows returned by pd.read_sql_query, the way every callback reads the database."""
+
+    def __init__(self):
+        self.rows = 0
+        self.__read_sql_query = pd.read_sql_query
+
+    def __call__(self, *args, **kwargs):
+        df = self.__read_sql_query(*args, **kwargs)
+        self.rows += len(df)
+        return df
+
+
+def payload(value):
+    '''Bytes of JSON sent to the browser'''
+    import plotly.utils
+    if hasattr(value, 'to_plotly_json'):
+        value = value.to_plotly_json()
+    return len(json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def run(name, call, counter, repeat):
+    times, rows, size = [], [], 0
+    for _ in range(repeat):
+        counter.rows = 0
+        start = time.perf_counter()
+        result = call()
+        times.append(time.perf_counter() - start)
+        rows.append(counter.rows)
+    size = payload(result)
+    return {'scenario': name, 'first_ms': round(times[0] * 1000, 1),
+            'p50_ms': round(float(np.percentile(times, 50)) * 1000, 1),
+            'p95_ms': round(float(np.percentile(times, 95)) * 1000, 1),
+            'rows': int(np.median(rows)), 'payload_kb': round(size / 1024, 1)}
+
+
+def scenarios(bourse, n_companies):
+    '''(name, callable) of every scenario'''
+    first, last = bourse.date_bounds()
+    last = pd.Timestamp(last)
+    for n in COMPANIES:
+        cids = list(range(1, min(n, n_companies) + 1))
+        for range_name, length in RANGES.items():
+            start = max(pd.Timestamp(first), last - length)
+            for graph_type in GRAPH_TYPES:
+                yield (f'update_graph {n} companies {range_name} {graph_type}',
+                       lambda cids=cids, start=start, graph_type=graph_type:
+                       bourse.update_graph(cids, str(start.date()), str(last.date()), graph_type, True)[0])
+    yield ('update_market_index 3 markets all', lambda: bourse.update_market_index([7, 8, 6], str(pd.Timestamp(first).date()),
+                                                                                   str(last.date())))
+    yield 'update_tab_content', lambda: bourse.update_tab_content('tab-1')
+    yield 'export_csv', lambda: bourse.export_csv(1, 'tab-1')
+    for text in SEARCHES:
+        yield f'filter_companies "{text}"', lambda text=text: bourse.filter_companies([], text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency of the dashboard callbacks')
+    parser.add_argument('--root', default='/tmp/bourse-benchmark', help='directory of the generated dataset')
+    parser.add_argument('--companies', type=int, default=20)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each scenario')
+    parser.add_argument('--only', default='', help='run the scenarios whose name contains this text')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    seed(os.path.abspath(args.root), args.companies, args.years)
+    os.environ['BOURSE_DATABASE_URI'] = 'parquet://' + os.path.abspath(args.root)
+    logging.basicConfig(level=logging.WARNING)
+    # the size of the figures is in the results, not in the logs
+    logging.getLogger('bourse').setLevel(logging.ERROR)
+    counter = RowCounter()
+    pd.read_sql_query = counter
+    import bourse
+
+    results = []
+    for name, call in scenarios(bourse, args.companies):
+        if args.only in name:
+            results.append(run(name, call, counter, args.repeat))
+            r = results[-1]
+            print(f"{r['scenario']:<50} first {r['first_ms']:>9} ms  p50 {r['p50_ms']:>9} ms  "
+                  f"p95 {r['p95_ms']:>9} ms  {r['rows']:>9} rows  {r['payload_kb']:>9} KB", flush=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
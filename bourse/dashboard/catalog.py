@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+'''
+  In-memory catalog of the companies table for the dashboard callbacks.
+
+  The companies table is small and read once at startup, so instead of
+  scanning the DataFrame (companies.loc[companies['id'] == id]) in every
+  callback we index it by company id and by market id, and we keep the
+  dropdown options ready for each market and each market combination.
+
+  It also holds the search index of the company dropdown: a sorted list of
+  (token, cid) where tokens are the lower case, accent free words of the name
+  and the symbol. A prefix lookup is a bisect in this list.
+'''
+
+import bisect
+import heapq
+import re
+import unicodedata
+
+MAX_SEARCH_RESULTS = 50
+
+_token_split = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    '''Lower case and remove accents: "Société Générale" -> "societe generale"'''
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii')
+    return text.lower()
+
+
+def tokenize(text):
+    return [token for token in _token_split.split(normalize(text)) if token]
+
+
+class CompanyCatalog:
+    """ Companies indexed by id (cid) and by market id (mid)."""
+
+    def __init__(self, companies):
+        """Build the catalog from the companies DataFrame
+
+        companies -- DataFrame with at least the id, name, symbol and mid columns
+        """
+        self.__by_id = {}           # cid -> (name, symbol, mid)
+        self.__by_market = {}       # mid -> [cid, ...]
+        self.__options = []         # dropdown options of every company
+        self.__market_options = {}  # mid -> dropdown options of the market
+        self.__combinations = {}    # sorted tuple of mid -> dropdown options
+        self.__option_by_id = {}    # cid -> dropdown option
+        self.__rank = {}            # cid -> position in the alphabetical order of labels
+        self.__normalized = {}      # cid -> (normalized name, normalized symbol)
+        tokens = set()
+
+        for cid, name, symbol, mid in zip(companies['id'], companies['name'],
+                                          companies['symbol'], companies['mid']):
+            cid = int(cid)
+            mid = int(mid)
+            self.__by_id[cid] = (name, symbol, mid)
+            self.__by_market.setdefault(mid, []).append(cid)
+            option = {'label': name + " - " + symbol, 'value': cid}
+            self.__options.append(option)
+            self.__market_options.setdefault(mid, []).append(option)
+            self.__option_by_id[cid] = option
+            self.__normalized[cid] = (normalize(name), normalize(symbol))
+            for token in tokenize(name) + tokenize(symbol) + [normalize(symbol)]:
+                tokens.add((token, cid))
+        self.__tokens = sorted(tokens)
+        for rank, cid in enumerate(sorted(self.__by_id, key=lambda cid: self.__normalized[cid])):
+            self.__rank[cid] = rank
+
+    def __contains__(self, cid):
+        return int(cid) in self.__by_id
+
+    def __len__(self):
+        return len(self.__by_id)
+
+    def name(self, cid):
+        return self.__by_id[int(cid)][0]
+
+    def symbol(self, cid):
+        return self.__by_id[int(cid)][1]
+
+    def market(self, cid):
+        return self.__by_id[int(cid)][2]
+
+    def label(self, cid):
+        name, symbol, _ = self.__by_id[int(cid)]
+        return f"{name} - {symbol}"
+
+    def option(self, cid):
+        return self.__option_by_id[int(cid)]
+
+    def companies_of(self, mid):
+        '''Return the ids of the companies of a market'''
+        return self.__by_market.get(int(mid), [])
+
+    def options(self, markets=None):
+        '''
+        Return the dropdown options of the companies of the given markets.
+
+        :param markets: list of market ids, every company if empty or None
+        :return: list of {'label', 'value'} dicts, shared between calls so do not modify it
+
+        The list of a single market is built with the catalog, the list of a
+        combination of markets is built on first use and then kept.
+        '''
+        if not markets:
+            return self.__options
+        key = tuple(sorted(set(int(mid) for mid in markets)))
+        if len(key) == 1:
+            return self.__market_options.get(key[0], [])
+        if key not in self.__combinations:
+            wanted = set(key)
+            self.__combinations[key] = [option for option in self.__options
+                                        if self.__by_id[option['value']][2] in wanted]
+        return self.__combinations[key]
+
+    def _prefix_matches(self, prefix):
+        '''Return the set of cids with a token starting with prefix'''
+        found = set()
+        i = bisect.bisect_left(self.__tokens, (prefix,))
+        while i < len(self.__tokens) and self.__tokens[i][0].startswith(prefix):
+            found.add(self.__tokens[i][1])
+            i += 1
+        return found
+
+    def search(self, text, markets=None, limit=MAX_SEARCH_RESULTS):
+        '''
+        Return the dropdown options of the companies matching what is typed.
+
+        :param text: words typed by the user, each one must prefix a word of the name or the symbol
+        :param markets: list of market ids to restrict the search to, every market if empty or None
+        :param limit: maximum number of options returned
+        :return: list of {'label', 'value'} dicts, best matches first
+
+        Exact symbols come first, then names starting with the text, then
+        the other matches, each group in alphabetical order. Without text the
+        first companies of the markets are returned.
+        '''
+        words = tokenize(text or '')
+        if not words:
+            return self.options(markets)[:limit]
+        found = None
+        for word in sorted(words, key=len, reverse=True):  # longest word first, smallest set
+            matches = self._prefix_matches(word)
+            found = matches if found is None else found & matches
+            if not found:
+                return []
+        if markets:
+            wanted = set(int(mid) for mid in markets)
+            found = [cid for cid in found if self.__by_id[cid][2] in wanted]
+        query = normalize(text).strip()
+
+        def score(cid):
+            name, symbol = self.__normalized[cid]
+            if symbol == query:
+                return (0, self.__rank[cid])
+            if name.startswith(query):
+                return (1, self.__rank[cid])
+            return (2, self.__rank[cid])
+
+        return [self.__option_by_id[cid] for cid in heapq.nsmallest(limit, found, key=score)]
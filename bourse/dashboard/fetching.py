@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Queries of the callbacks on a bounded pool of threads, cancelled when superseded.
+
+  A callback opens a request under its name, the queries it sends through the
+  request run on the threads of the Fetcher (at most FETCH_WORKERS connections
+  used by the callbacks) and the independent ones run at the same time:
+
+      with fetcher.request('update_graph') as request:
+          candles, ticks = request.read_all([(query1, params1, {}), (query2, params2, {})])
+
+  When the same callback is called again for the same browser (the user changed
+  the range while a five years query runs), the queries of the previous request
+  are cancelled in the database (psycopg2 cancel, DuckDB interrupt) and the
+  ones not started are dropped. The previous callback then ends with
+  PreventUpdate, only the new one updates the page. A browser is known by the
+  CLIENT_COOKIE cookie, several users behind the same proxy share an address.
+'''
+
+import concurrent.futures
+import threading
+import uuid
+
+import dash.exceptions
+import flask
+import pandas as pd
+import sqlalchemy
+
+import sql_profiling
+
+FETCH_WORKERS = 4  # queries of the callbacks running at the same time, each holds a connection of the pool
+CLIENT_COOKIE = 'bourse_client'  # id of the browser
+
+
+def statement(query, params):
+    '''SQL text with bound parameters (:name), a list parameter is for an IN (:name)'''
+    return sqlalchemy.text(query).bindparams(*[sqlalchemy.bindparam(name, expanding=True)
+                                               for name, value in params.items() if isinstance(value, list)])
+
+
+def cancel_connection(dbapi_connection):
+    '''Stop the query running on a connection, from another thread'''
+    if hasattr(dbapi_connection, 'cancel'):  # psycopg2
+        dbapi_connection.cancel()
+    elif hasattr(dbapi_connection, 'interrupt'):  # DuckDB
+        dbapi_connection.interrupt()
+
+
+class Superseded(Exception):
+    """ The request was replaced by a newer one of the same callback and browser."""
+
+
+class Request:
+    """ Queries of one call of a callback, see Fetcher.request."""
+
+    def __init__(self, fetcher, slot):
+        self.slot = slot
+        self.cancelled = False
+        self.__fetcher = fetcher
+        self.__lock = threading.Lock()
+        self.__connections = set()  # DBAPI connections running a query of this request
+        self.__futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.__fetcher.done(self)
+        if exc_type is Superseded:
+            raise dash.exceptions.PreventUpdate() from exc
+        return False
+
+    def cancel(self):
+        with self.__lock:
+            self.cancelled = True
+            for future in self.__futures:
+                future.cancel()
+            for connection in self.__connections:
+                cancel_connection(connection)
+
+    def _read(self, query, params, kwargs, callback):
+        if self.cancelled:
+            raise Superseded()
+        # the callback of the queries is known in the thread of the request, not in this one
+        with sql_profiling.callback(callback), self.__fetcher.engine.connect() as connection:
+            dbapi_connection = connection.connection.dbapi_connection
+            with self.__lock:
+                if self.cancelled:
+                    raise Superseded()
+                self.__connections.add(dbapi_connection)
+            try:
+                return pd.read_sql_query(statement(query, params), connection, params=params, **kwargs)
+            except Exception as e:
+                if self.cancelled:
+                    raise Superseded() from e
+                raise
+            finally:
+                with self.__lock:
+                    self.__connections.discard(dbapi_connection)
+
+    def read_all(self, queries):
+        '''
+        Run queries at the same time and return their DataFrames in the same order
+
+        :param queries: list of (query, params, keyword arguments of pd.read_sql_query)
+        '''
+        callback = sql_profiling.current_callback()
+        with self.__lock:
+            if self.cancelled:
+                raise Superseded()
+            futures = [self.__fetcher.executor.submit(self._read, query, params, kwargs, callback)
+                       for query, params, kwargs in queries]
+            self.__futures.extend(futures)
+        try:
+            return [future.result() for future in futures]
+        except concurrent.futures.CancelledError as e:
+            raise Superseded() from e
+        except BaseException:
+            # the other queries are of no use anymore
+            for future in futures:
+                future.cancel()
+            raise
+
+    def read_sql(self, query, params, **kwargs):
+        return self.read_all([(query, params, kwargs)])[0]
+
+
+class Fetcher:
+    """ Bounded pool of threads running the queries of the callbacks, one current request per callback and browser."""
+
+    def __init__(self, engine, workers=FETCH_WORKERS):
+        self.engine = engine
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fetch')
+        self.__lock = threading.Lock()
+        self.__current = {}  # slot -> running request
+
+    @staticmethod
+    def client():
+        '''Id of the browser calling the callback (a new one is set in its cookies), None outside of a request'''
+        if not flask.has_request_context():
+            return None  # benchmark, tests
+        client = flask.request.cookies.get(CLIENT_COOKIE) or flask.g.get('client')
+        if client is None:
+            client = flask.g.client = uuid.uuid4().hex
+
+            @flask.after_this_request
+            def set_cookie(response):
+                response.set_cookie(CLIENT_COOKIE, client, httponly=True, samesite='Lax')
+                return response
+        return client
+
+    def request(self, name):
+        '''Start a request of the callback name, the previous one of the same browser is cancelled'''
+        request = Request(self, (name, self.client()))
+        with self.__lock:
+            previous = self.__current.get(request.slot)
+            self.__current[request.slot] = request
+        if previous is not None:
+            previous.cancel()
+        return request
+
+    def done(self, request):
+        with self.__lock:
+            if self.__current.get(request.slot) is request:
+                del self.__current[request.slot]
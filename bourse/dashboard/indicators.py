@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Technical indicators computed with NumPy on a (time x company) array.
+
+  Every indicator takes the dates (T,), the prices (T x N) and the volumes
+  (T x N) of N companies and returns a dict of (T x N) outputs and a state.
+  Giving this state back with the rows that follow computes only these new
+  rows, with the same result as computing the whole series again.
+
+  Missing prices (a company without a quote at a date where others have one)
+  are filled with the previous price of the company before computing.
+
+  >>> dates = np.arange('2023-01-02', '2023-01-07', dtype='datetime64[D]')
+  >>> prices = np.array([[1., 10.], [2., 11.], [3., np.nan], [4., 13.], [5., 14.]])
+  >>> out, state = run('sma', dates, prices, np.ones_like(prices), window=3)
+  >>> out['sma'][:, 0]
+  array([nan, nan,  2.,  3.,  4.])
+  >>> out['sma'][:, 1]
+  array([        nan,         nan, 10.66666667, 11.66666667, 12.66666667])
+  >>> out2, _ = run('sma', dates[:0], prices[:0], prices[:0], window=3)
+  >>> out2['sma'].shape
+  (0, 2)
+'''
+
+import collections
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------ helpers --------------------------------
+
+def ffill(prices, last=None):
+    '''Fill NaN with the previous price of the same column, `last` is the price before the first row'''
+    prices = np.array(prices, dtype=np.float64)
+    if last is not None and len(prices):
+        prices[0] = np.where(np.isnan(prices[0]), last, prices[0])
+    valid = ~np.isnan(prices)
+    rows = np.where(valid, np.arange(len(prices))[:, None], 0)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    filled = prices[rows, np.arange(prices.shape[1])]
+    # before the first quote of a company there is nothing to carry
+    seen = np.logical_or.accumulate(valid, axis=0)
+    return np.where(seen, filled, np.nan)
+
+
+def _windowed(prices, tail, window):
+    '''Prepend the rows kept from the previous call, return the rows and the new tail'''
+    if tail is None:
+        tail = np.full((0, prices.shape[1]), np.nan)
+    x = np.vstack([tail, prices])
+    return x, x[len(x) - (window - 1):] if window > 1 else x[:0]
+
+
+def _rolling_sums(x, window):
+    '''Sum, sum of squares and number of values of each window ending at each row'''
+    valid = ~np.isnan(x)
+    # center by column to limit the cancellation in the sum of squares
+    with np.errstate(all='ignore'):
+        center = np.nanmean(x, axis=0) if len(x) else np.zeros(x.shape[1])
+    center = np.nan_to_num(center)
+    filled = np.where(valid, x - center, 0.0)
+    zero = np.zeros((1, x.shape[1]))
+    c1 = np.vstack([zero, np.cumsum(filled, axis=0)])
+    c2 = np.vstack([zero, np.cumsum(filled * filled, axis=0)])
+    cn = np.vstack([zero, np.cumsum(valid, axis=0)])
+    lo = np.maximum(np.arange(1, len(x) + 1) - window, 0)
+    hi = np.arange(1, len(x) + 1)
+    return c1[hi] - c1[lo], c2[hi] - c2[lo], cn[hi] - cn[lo], center
+
+
+def _rolling_mean_std(x, window):
+    s1, s2, n, center = _rolling_sums(x, window)
+    full = n == window  # like pandas rolling(window), NaN until the window is full
+    with np.errstate(all='ignore'):
+        mean = s1 / window
+        var = np.maximum(s2 - s1 * s1 / window, 0.0) / (window - 1) if window > 1 else np.zeros_like(s1)
+    return np.where(full, mean + center, np.nan), np.where(full, np.sqrt(var), np.nan)
+
+
+def _smooth(x, alpha, last):
+    '''Exponential smoothing along the time axis (pandas ewm(adjust=False)), NaN rows keep the last value'''
+    out = np.empty_like(x)
+    for i in range(len(x)):
+        row = x[i]
+        last = np.where(np.isnan(row), last,
+                        np.where(np.isnan(last), row, alpha * row + (1 - alpha) * last))
+        out[i] = last
+    return out, last
+
+
+def _nan_row(n):
+    return np.full(n, np.nan)
+
+# ------------------------------ indicators --------------------------------
+
+def sma(dates, prices, volumes, state=None, window=20):
+    '''Simple moving average over `window` rows'''
+    x, tail = _windowed(prices, state and state['tail'], window)
+    mean, _ = _rolling_mean_std(x, window)
+    return {'sma': mean[len(x) - len(prices):]}, {'tail': tail}
+
+
+def bollinger(dates, prices, volumes, state=None, window=20, k=2):
+    '''Moving average over `window` rows and bands at `k` standard deviations'''
+    x, tail = _windowed(prices, state and state['tail'], window)
+    mean, std = _rolling_mean_std(x, window)
+    mean = mean[len(x) - len(prices):]
+    std = std[len(x) - len(prices):]
+    return {'middle': mean, 'upper': mean + k * std, 'lower': mean - k * std}, {'tail': tail}
+
+
+def ema(dates, prices, volumes, state=None, span=20):
+    '''Exponential moving average, alpha = 2 / (span + 1)'''
+    last = state['last'] if state else _nan_row(prices.shape[1])
+    out, last = _smooth(prices, 2 / (span + 1), last)
+    return {'ema': out}, {'last': last}
+
+
+def rsi(dates, prices, volumes, state=None, period=14):
+    '''Relative strength index with Wilder smoothing (alpha = 1 / period)'''
+    n = prices.shape[1]
+    if state:
+        previous, gain, loss, count = state['previous'], state['gain'], state['loss'], state['count']
+    else:
+        previous, gain, loss, count = _nan_row(n), _nan_row(n), _nan_row(n), np.zeros(n)
+    diff = np.diff(np.vstack([previous[None, :], prices]), axis=0)
+    gain_out, gain = _smooth(np.where(np.isnan(diff), np.nan, np.maximum(diff, 0)), 1 / period, gain)
+    loss_out, loss = _smooth(np.where(np.isnan(diff), np.nan, np.maximum(-diff, 0)), 1 / period, loss)
+    counts = count + np.cumsum(~np.isnan(diff), axis=0)
+    with np.errstate(all='ignore'):
+        out = np.where(loss_out == 0, 100.0, 100 - 100 / (1 + gain_out / loss_out))
+    out = np.where(counts >= period, out, np.nan)
+    if len(prices):
+        previous = np.where(np.isnan(prices[-1]), previous, prices[-1])
+        count = counts[-1]
+    return {'rsi': out}, {'previous': previous, 'gain': gain, 'loss': loss, 'count': count}
+
+
+def vwap(dates, prices, volumes, state=None):
+    '''Volume weighted average price since the beginning of each day'''
+    n = prices.shape[1]
+    days = np.asarray(dates, dtype='datetime64[D]')
+    pv = np.nan_to_num(prices * volumes)
+    v = np.nan_to_num(np.asarray(volumes, dtype=np.float64))
+    cpv = np.cumsum(pv, axis=0)
+    cv = np.cumsum(v, axis=0)
+    # index of the first row of the day of each row
+    new_day = np.ones(len(days), dtype=bool)
+    new_day[1:] = days[1:] != days[:-1]
+    start = np.maximum.accumulate(np.where(new_day, np.arange(len(days)), 0)) if len(days) else np.zeros(0, dtype=int)
+    before_pv = np.where(start[:, None] > 0, cpv[start - 1], 0.0) if len(days) else cpv
+    before_v = np.where(start[:, None] > 0, cv[start - 1], 0.0) if len(days) else cv
+    cpv = cpv - before_pv
+    cv = cv - before_v
+    if state and len(days):
+        # the first rows continue the day of the previous call
+        same = (days == state['day']) & (start == 0)
+        cpv = cpv + np.where(same[:, None], state['pv'], 0.0)
+        cv = cv + np.where(same[:, None], state['v'], 0.0)
+    with np.errstate(all='ignore'):
+        out = np.where(cv > 0, cpv / cv, np.nan)
+    if len(days):
+        state = {'day': days[-1], 'pv': cpv[-1], 'v': cv[-1]}
+    elif state is None:
+        state = {'day': np.datetime64('NaT', 'D'), 'pv': np.zeros(n), 'v': np.zeros(n)}
+    return {'vwap': out}, state
+
+
+INDICATORS = {
+    'sma': sma,
+    'bollinger': bollinger,
+    'ema': ema,
+    'rsi': rsi,
+    'vwap': vwap,
+}
+
+
+def run(name, dates, prices, volumes, state=None, **params):
+    '''
+    Compute an indicator on the rows of N companies.
+
+    :param name: one of INDICATORS
+    :param dates: (T,) dates of the rows, sorted
+    :param prices: (T x N) prices, NaN when a company has no quote
+    :param volumes: (T x N) volumes
+    :param state: state returned by the previous call when these rows follow it
+    :param params: parameters of the indicator (window, span, period...)
+    :return: dict of (T x N) outputs, state for the next call
+    '''
+    last = None if state is None else state['price']
+    prices = ffill(prices, last)
+    volumes = np.asarray(volumes, dtype=np.float64)
+    outputs, inner = INDICATORS[name](dates, prices, volumes, None if state is None else state['inner'], **params)
+    if len(prices):
+        last = prices[-1]
+    elif last is None:
+        last = _nan_row(prices.shape[1])
+    return outputs, {'price': last, 'inner': inner}
+
+
+def state_column(state, j):
+    '''State of the j-th company of a state'''
+    if isinstance(state, dict):
+        return {k: state_column(v, j) for k, v in state.items()}
+    if isinstance(state, np.ndarray) and state.ndim > 0:
+        return state[..., j]
+    return state
+
+
+def stack_states(states):
+    '''State of several companies from their own states, inverse of state_column'''
+    first = states[0]
+    if isinstance(first, dict):
+        return {k: stack_states([s[k] for s in states]) for k in first}
+    if isinstance(first, np.ndarray):
+        return np.stack(states, axis=-1)
+    if isinstance(first, np.datetime64):
+        return max(states)
+    return first
+
+# ------------------------------ panel --------------------------------
+
+def pivot(df, cids, price='close', volume='volume', after=None):
+    '''
+    Turn a long frame of daily rows (date, cid, price, volume) into a (day x company) panel.
+
+    :param after: the panel goes on a previous one ending at this date
+    :return: dates (T,), prices (T x N), volumes (T x N), present (T x N) mask of the
+             rows the company really has, columns in the order of cids
+
+    Rows are every business day from the first date (or the day after `after`)
+    to the last one, so a company gets the same rows whatever the other
+    companies of the panel are.
+    '''
+    df = df.drop_duplicates(['date', 'cid'], keep='last')
+    prices = df.pivot(index='date', columns='cid', values=price).reindex(columns=cids)
+    volumes = df.pivot(index='date', columns='cid', values=volume).reindex(columns=cids)
+    dates = prices.index
+    if getattr(dates, 'tz', None) is not None:
+        dates = dates.tz_localize(None)
+        prices.index = volumes.index = dates
+    if len(dates):
+        first = dates.min() if after is None else pd.Timestamp(after) + pd.Timedelta(days=1)
+        calendar = pd.bdate_range(first, dates.max()).union(dates)
+        prices = prices.reindex(calendar)
+        volumes = volumes.reindex(calendar)
+        dates = calendar
+    prices = prices.to_numpy(dtype=np.float64)
+    return (np.asarray(dates, dtype='datetime64[ns]'), prices,
+            volumes.to_numpy(dtype=np.float64), ~np.isnan(prices))
+
+# ------------------------------ cache --------------------------------
+
+# Result of an indicator for one company on a range: 1D arrays of the rows
+# the company has, outputs by name, state to extend it, date of the last
+# panel row used and time of computation
+Result = collections.namedtuple('Result', 'dates prices volumes outputs state last_date computed')
+
+
+class IndicatorCache:
+    """ Indicator results per (cid, indicator, params, range), least recently used dropped first, shared by the threads of the server."""
+
+    def __init__(self, max_entries=1024, max_age=60):
+        '''
+        max_entries -- number of (cid, indicator, params, range) kept
+        max_age     -- seconds after which a result is checked for new rows
+        '''
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()  # the callbacks run on several threads
+        self.__max_entries = max_entries
+        self.__max_age = max_age
+
+    @staticmethod
+    def _key(cid, name, params, start, end):
+        return (int(cid), name, tuple(sorted(params.items())), str(start), str(end))
+
+    def get(self, cid, name, params, start, end):
+        '''Return (result, fresh) for exactly this range, (None, False) if unknown'''
+        with self.__lock:
+            return self._get(cid, name, params, start, end)
+
+    def _get(self, cid, name, params, start, end):
+        key = self._key(cid, name, params, start, end)
+        result = self.__entries.get(key)
+        if result is None:
+            return None, False
+        self.__entries.move_to_end(key)
+        return result, time.time() - result.computed < self.__max_age
+
+    def closest(self, cid, name, params, start, end):
+        '''Return the result with the same start and the latest end before `end`, to extend it'''
+        with self.__lock:
+            return self._closest(cid, name, params, start, end)
+
+    def _closest(self, cid, name, params, start, end):
+        cid, name, params, start, end = self._key(cid, name, params, start, end)
+        best = None
+        for (c, n, p, s, e), result in self.__entries.items():
+            if (c, n, p, s) == (cid, name, params, start) and e < end and (best is None or e > best[0]):
+                best = (e, result)
+        return None if best is None else best[1]
+
+    def put(self, cid, name, params, start, end, result):
+        with self.__lock:
+            self._put(cid, name, params, start, end, result)
+
+    def _put(self, cid, name, params, start, end, result):
+        self.__entries[self._key(cid, name, params, start, end)] = result
+        self.__entries.move_to_end(self._key(cid, name, params, start, end))
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def compute(self, name, params, cids, start, end, fetch):
+        '''
+        Return the results of an indicator for several companies, computing only what is missing.
+
+        :param name: one of INDICATORS
+        :param params: dict of parameters of the indicator
+        :param cids: company ids
+        :param start, end: range asked
+        :param fetch: fetch(cids, after) returns the long frame of daily rows (date, cid, close, volume)
+                      of these companies in [start, end], only rows after `after` if it is not None
+        :return: dict cid -> Result
+
+        Companies without result are computed together with one fetch. A
+        result of the same range which is too old, or of a shorter range with
+        the same start, is extended with the rows after its last date only.
+        The lock is not held while fetching and computing, two threads may compute
+        the same result, the last one is kept.
+        '''
+        results = {}
+        todo = collections.defaultdict(list)  # last date to extend from (None: everything) -> [(cid, result)]
+        with self.__lock:
+            for cid in cids:
+                result, fresh = self._get(cid, name, params, start, end)
+                if result is not None and fresh:
+                    results[cid] = result
+                    continue
+                if result is None:
+                    result = self._closest(cid, name, params, start, end)
+                todo[None if result is None else result.last_date].append((cid, result))
+
+        for after, group in todo.items():
+            group_cids = [cid for cid, _ in group]
+            dates, prices, volumes, present = pivot(fetch(group_cids, after), group_cids, after=after)
+            state = None if after is None else stack_states([result.state for _, result in group])
+            outputs, state = run(name, dates, prices, volumes, state, **params)
+            now = time.time()
+            last_date = dates[-1] if len(dates) else after
+            for j, (cid, previous) in enumerate(group):
+                mask = present[:, j]
+                new = Result(dates[mask], prices[mask, j], volumes[mask, j],
+                             {k: v[mask, j] for k, v in outputs.items()},
+                             state_column(state, j), last_date, now)
+                if previous is not None:
+                    new = Result(np.concatenate([previous.dates, new.dates]),
+                                 np.concatenate([previous.prices, new.prices]),
+                                 np.concatenate([previous.volumes, new.volumes]),
+                                 {k: np.concatenate([previous.outputs[k], new.outputs[k]]) for k in new.outputs},
+                                 new.state, last_date, now)
+                self.put(cid, name, params, start, end, new)
+                results[cid] = new
+        return results
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Timing of the SQL queries of the dashboard.
+
+  instrument(app, engine) hooks the SQLAlchemy engine so that every query is
+  timed and counted under the Dash callback running it (the output of the
+  callback, e.g. 'graph.figure'), whatever calls it (pd.read_sql_query...).
+  The threads running queries for a callback (fetching.py) tag them with
+
+      with sql_profiling.callback('graph.figure'):
+          ...
+
+  Each callback keeps a latency histogram, with the buckets of the analyzer
+  (analyzer/profiling.py, which is not shipped with the dashboard). The first
+  slow run of a statement gets its plan captured with EXPLAIN ANALYZE, on a
+  thread of its own: the callback does not wait for it, and it does not use
+  the connection of the callback (DuckDB has one per thread).
+
+  With BOURSE_DEBUG_QUERIES=1 the statistics are served as JSON on /debug/queries
+  (POST to clear them). The route is off by default: it shows the SQL and its
+  parameters to anyone reaching the dashboard.
+
+  >>> p = QueryStats(slow=10)
+  >>> with callback('graph.figure'):
+  ...     p.record('SELECT 1', None, 0.002)
+  >>> p.report()['stats'][0]['callback'], p.report()['stats'][0]['count']
+  ('graph.figure', 1)
+'''
+
+import bisect
+import concurrent.futures
+import contextlib
+import json
+import os
+import threading
+import time
+
+import flask
+import sqlalchemy
+
+SLOW_QUERY = 1.0  # seconds, slower queries are explained
+MAX_SLOW_QUERIES = 50  # plans kept
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)  # upper bounds of the histogram in seconds
+DEBUG_QUERIES = os.environ.get('BOURSE_DEBUG_QUERIES') == '1'  # serve /debug/queries
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def callback(name):
+    '''Tag the queries sent in this block (and in this thread) with the callback name'''
+    previous = getattr(_local, 'callback', None)
+    _local.callback = name
+    try:
+        yield
+    finally:
+        _local.callback = previous
+
+
+def current_callback():
+    return getattr(_local, 'callback', None) or 'unknown'
+
+
+class QueryStats:
+    """ Latency histograms of the queries per callback and plans of the slow ones."""
+
+    def __init__(self, slow=SLOW_QUERY, explain=None):
+        '''
+        slow    -- threshold in seconds above which a query is explained
+        explain -- explain(statement, parameters) runs an EXPLAIN statement and returns its lines
+        '''
+        self.slow = slow
+        self.__explain = explain
+        self.__lock = threading.Lock()
+        self.__stats = {}  # callback -> [count, total, max, histogram]
+        self.__slow_queries = []
+        self.__explained = set()  # (callback, statement) whose plan was captured
+        self.__explainer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='explain')
+
+    def record(self, statement, parameters, duration):
+        if getattr(_local, 'explaining', False):
+            return
+        name = current_callback()
+        with self.__lock:
+            stats = self.__stats.setdefault(name, [0, 0.0, 0.0, [0] * (len(BUCKETS) + 1)])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3][bisect.bisect_left(BUCKETS, duration)] += 1
+            # EXPLAIN ANALYZE runs the query again, only its first slow run is explained
+            first = duration > self.slow and (name, statement) not in self.__explained
+            self.__explained.add((name, statement))
+        if first and self.__explain is not None:
+            self.__explainer.submit(self._capture, name, statement, parameters, duration, True)
+        elif duration > self.slow:
+            self._capture(name, statement, parameters, duration, False)
+
+    def _capture(self, name, statement, parameters, duration, explain):
+        plan = None
+        if explain:
+            _local.explaining = True  # the EXPLAIN itself is not recorded
+            try:
+                # the dashboard only reads
+                plan = self.__explain('EXPLAIN ANALYZE ' + statement, parameters)
+            except Exception as e:
+                plan = ['EXPLAIN failed: %s' % e]
+            finally:
+                _local.explaining = False
+        with self.__lock:
+            self.__slow_queries.append({'callback': name, 'seconds': round(duration, 4),
+                                        'query': statement, 'plan': plan})
+            del self.__slow_queries[:-MAX_SLOW_QUERIES]
+
+    def report(self):
+        '''Statistics as a JSON compatible dict, slowest callbacks first'''
+        with self.__lock:
+            stats = [{'callback': name, 'count': count, 'total': round(total, 4),
+                      'mean': round(total / count, 4), 'max': round(longest, 4),
+                      'histogram': dict(zip(['<=%gs' % b for b in BUCKETS] + ['>%gs' % BUCKETS[-1]], histogram))}
+                     for name, (count, total, longest, histogram) in self.__stats.items()]
+            slow_queries = list(self.__slow_queries)
+        stats.sort(key=lambda s: s['total'], reverse=True)
+        return {'slow_threshold': self.slow, 'stats': stats, 'slow_queries': slow_queries}
+
+    def reset(self):
+        with self.__lock:
+            self.__stats.clear()
+            self.__slow_queries.clear()
+            self.__explained.clear()
+
+
+def instrument(app, engine, profiler=None):
+    '''
+    Time every query of engine, tag it with the Dash callback of the request and serve the report if DEBUG_QUERIES
+
+    :return: the QueryStats used
+    '''
+    if profiler is None:
+        def explain(statement, parameters):
+            with engine.connect() as connection:
+                return [row[0] for row in connection.exec_driver_sql(statement, parameters)]
+        profiler = QueryStats(explain=explain)
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        profiler.record(statement, parameters, time.perf_counter() - start)
+
+    @sqlalchemy.event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        # a failed (or cancelled) query has no after_cursor_execute
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('query_start'):
+            connection.info['query_start'].pop()
+
+    @app.server.before_request
+    def tag_callback():
+        name = None
+        if flask.request.path.endswith('/_dash-update-component'):
+            body = flask.request.get_json(silent=True) or {}
+            name = body.get('output')
+        _local.callback = name
+
+    if DEBUG_QUERIES:
+        @app.server.route('/debug/queries', methods=['GET', 'POST'])
+        def debug_queries():
+            report = profiler.report()
+            if flask.request.method == 'POST':
+                profiler.reset()
+            return flask.Response(json.dumps(report, indent=2, default=str), mimetype='application/json')
+
+    return profiler